@@ -0,0 +1,368 @@
+"""
+Decoders that can be used for the timepoint sweeps in run_decoding.py.
+
+Decoders are registered by name with register_decoder and created with get_decoder. There are two kinds:
+    - sklearn estimators (e.g. the SVC pipeline), which are fitted separately for every timepoint
+    - batched decoders (batched = True), which take data with shape (n_timepoints, n_trials, n_sources) and fit all timepoints at once
+
+Feature selection is not part of the decoders. The sources are selected per fold for all timepoints at once with f_classif_batched and top_k_features (see across_subject in run_decoding.py).
+"""
+
+import numpy as np
+from sklearn import svm
+from sklearn.base import BaseEstimator
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
+
+DECODERS = {}
+
+def register_decoder(name):
+    """
+    Decorator registering a function that creates a decoder under the given name.
+    """
+    def decorator(func):
+        DECODERS[name] = func
+        return func
+
+    return decorator
+
+def get_decoder(name, **kwargs):
+    """
+    Creates a registered decoder.
+
+    Parameters
+    ----------
+    name : str
+        Name of the decoder.
+    **kwargs
+        Arguments passed on to the function creating the decoder.
+
+    Returns
+    -------
+    decoder
+        The decoder.
+    """
+    if name not in DECODERS:
+        raise ValueError(f"Unknown decoder {name}, choose one of {list(DECODERS)}")
+
+    return DECODERS[name](**kwargs)
+
+
+class BatchedLinearClassifier(BaseEstimator):
+    """
+    Base class for binary linear classifiers fitted for all timepoints at once.
+
+    The data is standardised per timepoint and source using the training trials (as StandardScaler does). Subclasses implement fit_standardised, which sets coef_ with shape (n_timepoints, n_sources) and intercept_ with shape (n_timepoints, ).
+    """
+    batched = True
+
+    def fit(self, X, y):
+        """
+        Parameters
+        ----------
+        X : array
+            Data array with shape (n_timepoints, n_trials, n_sources).
+        y : array
+            Label array with shape (n_trials, ) with two classes.
+        """
+        self.classes_ = np.unique(y)
+        if len(self.classes_) != 2:
+            raise ValueError(f"{type(self).__name__} only supports two classes")
+
+        self.mean_ = X.mean(axis = 1, keepdims = True)
+        self.scale_ = X.std(axis = 1, keepdims = True)
+        self.scale_[self.scale_ == 0] = 1
+
+        self.fit_standardised((X - self.mean_) / self.scale_, y == self.classes_[1])
+
+        return self
+
+    def decision_function(self, X):
+        """
+        Parameters
+        ----------
+        X : array
+            Data array with shape (n_timepoints, n_trials, n_sources).
+
+        Returns
+        -------
+        decision : array
+            Array with shape (n_timepoints, n_trials). Positive values predict the second class.
+        """
+        Z = (X - self.mean_) / self.scale_
+
+        return np.einsum("tns,ts->tn", Z, self.coef_) + self.intercept_[:, np.newaxis]
+
+    def generalisation_decision_function(self, X, features = None):
+        """
+        Decision function of the model of every training timepoint on every test timepoint (temporal generalisation).
+
+        The standardisation is folded into the coefficients, so all pairs of timepoints are evaluated with one matrix product.
+
+        Parameters
+        ----------
+        X : array
+            Data array with all sources with shape (n_test_timepoints, n_trials, n_sources).
+        features : array, optional
+            Sources the model of each training timepoint was fitted on with shape (n_timepoints, k). If None (default), the models were fitted on all sources.
+
+        Returns
+        -------
+        decision : array
+            Array with shape (n_timepoints, n_test_timepoints, n_trials).
+        """
+        coef = self.coef_ / self.scale_[:, 0]
+        intercept = self.intercept_ - np.einsum("ts,ts->t", coef, self.mean_[:, 0])
+
+        if features is not None: # coefficients of the sources that were not selected are zero
+            coef_all = np.zeros((len(coef), X.shape[2]), dtype = coef.dtype)
+            np.put_along_axis(coef_all, features, coef, axis = 1)
+            coef = coef_all
+
+        U, N, S = X.shape
+        decision = (X.reshape(U * N, S) @ coef.T).reshape(U, N, -1)
+
+        return decision.transpose(2, 0, 1) + intercept[:, np.newaxis, np.newaxis]
+
+    def predict(self, X):
+        return self.classes_[(self.decision_function(X) > 0).astype(int)]
+
+    def score(self, X, y):
+        """
+        Returns
+        -------
+        scores : array
+            Accuracy for each timepoint with shape (n_timepoints, ).
+        """
+        return np.mean(self.predict(X) == y[np.newaxis, :], axis = 1)
+
+    def score_generalisation(self, X, y, features = None):
+        """
+        Accuracy of the model of every training timepoint on every test timepoint. See generalisation_decision_function for the parameters.
+
+        Returns
+        -------
+        scores : array
+            Array with shape (n_timepoints, n_test_timepoints).
+        """
+        predictions = self.classes_[(self.generalisation_decision_function(X, features) > 0).astype(int)]
+
+        return np.mean(predictions == y, axis = 2)
+
+
+class BatchedRidgeClassifier(BatchedLinearClassifier):
+    """
+    Ridge classifier (least squares on -1/1 targets with an L2 penalty), solved for all timepoints with stacked normal equations.
+
+    The primal (n_sources x n_sources) or dual (n_trials x n_trials) system is solved, whichever is smaller.
+    """
+    def __init__(self, alpha = 1.0):
+        self.alpha = alpha
+
+    def fit_standardised(self, Z, is_second_class):
+        targets = np.where(is_second_class, 1.0, -1.0)
+        target_mean = targets.mean()
+        targets = targets - target_mean
+
+        T, N, S = Z.shape
+
+        if S <= N: # primal: (Z^T Z + alpha I) w = Z^T t
+            gram = np.einsum("tns,tnr->tsr", Z, Z)
+            gram[:, np.arange(S), np.arange(S)] += self.alpha
+            self.coef_ = np.linalg.solve(gram, np.einsum("tns,n->ts", Z, targets)[..., np.newaxis])[..., 0]
+        else: # dual: (Z Z^T + alpha I) a = t, w = Z^T a
+            gram = np.einsum("tns,tms->tnm", Z, Z)
+            gram[:, np.arange(N), np.arange(N)] += self.alpha
+            dual_coef = np.linalg.solve(gram, np.broadcast_to(targets[:, np.newaxis], (T, N, 1)))[..., 0]
+            self.coef_ = np.einsum("tns,tn->ts", Z, dual_coef)
+
+        self.intercept_ = np.full(T, target_mean)
+
+
+def ridge_test_projection(X_train, X_test, alpha = 1.0):
+    """
+    Matrix mapping centred training targets to the ridge decision function on the test trials, for all timepoints.
+
+    The matrix only depends on the data, so the decision function for any labelling of the training trials (e.g. permuted labels) is one matrix product: decision = H @ (t - t.mean()) + t.mean(), with t the -1/1 targets. This gives the same decision function as BatchedRidgeClassifier.
+
+    Parameters
+    ----------
+    X_train : array
+        Training data with shape (n_timepoints, n_train_trials, n_sources).
+    X_test : array
+        Test data with shape (n_timepoints, n_test_trials, n_sources).
+    alpha : float, optional
+        Regularisation strength, by default 1.0.
+
+    Returns
+    -------
+    H : array
+        Array with shape (n_timepoints, n_test_trials, n_train_trials).
+    """
+    mean = X_train.mean(axis = 1, keepdims = True)
+    scale = X_train.std(axis = 1, keepdims = True)
+    scale[scale == 0] = 1
+
+    Z_train = (X_train - mean) / scale
+    Z_test = (X_test - mean) / scale
+
+    T, N, S = Z_train.shape
+
+    if S <= N: # primal: H = Z_test (Z^T Z + alpha I)^-1 Z^T
+        gram = np.einsum("tns,tnr->tsr", Z_train, Z_train)
+        gram[:, np.arange(S), np.arange(S)] += alpha
+        return Z_test @ np.linalg.solve(gram, Z_train.transpose(0, 2, 1))
+    else: # dual: H = Z_test Z^T (Z Z^T + alpha I)^-1
+        gram = np.einsum("tns,tms->tnm", Z_train, Z_train)
+        gram[:, np.arange(N), np.arange(N)] += alpha
+        cross_gram = np.einsum("tms,tns->tmn", Z_test, Z_train)
+        return np.linalg.solve(gram, cross_gram.transpose(0, 2, 1)).transpose(0, 2, 1)
+
+
+class BatchedShrinkageLDA(BatchedLinearClassifier):
+    """
+    Linear discriminant analysis with a pooled within-class covariance shrunk towards a scaled identity, solved for all timepoints at once.
+
+    If shrinkage is None, the shrinkage is estimated for each timepoint with the Ledoit-Wolf formula (as in sklearn.covariance.ledoit_wolf_shrinkage).
+    """
+    def __init__(self, shrinkage = None):
+        self.shrinkage = shrinkage
+
+    def fit_standardised(self, Z, is_second_class):
+        T, N, S = Z.shape
+
+        mean_0 = Z[:, ~is_second_class].mean(axis = 1)
+        mean_1 = Z[:, is_second_class].mean(axis = 1)
+
+        # remove the class means to get the within-class data
+        centered = Z - np.where(is_second_class[np.newaxis, :, np.newaxis], mean_1[:, np.newaxis], mean_0[:, np.newaxis])
+        cov = np.einsum("tns,tnr->tsr", centered, centered) / N
+
+        shrinkage = self.shrinkage
+        if shrinkage is None:
+            shrinkage = ledoit_wolf_shrinkage_batched(centered, cov)
+        shrinkage = np.broadcast_to(shrinkage, (T, ))
+
+        mu = np.trace(cov, axis1 = 1, axis2 = 2) / S
+        cov *= (1 - shrinkage)[:, np.newaxis, np.newaxis]
+        cov[:, np.arange(S), np.arange(S)] += (shrinkage * mu)[:, np.newaxis]
+
+        self.coef_ = np.linalg.solve(cov, (mean_1 - mean_0)[..., np.newaxis])[..., 0]
+
+        prior_1 = is_second_class.mean()
+        self.intercept_ = -0.5 * np.einsum("ts,ts->t", self.coef_, mean_0 + mean_1) + np.log(prior_1 / (1 - prior_1))
+
+
+def ledoit_wolf_shrinkage_batched(X, cov):
+    """
+    Ledoit-Wolf shrinkage for each timepoint (same formula as sklearn.covariance.ledoit_wolf_shrinkage with assume_centered=True).
+
+    Parameters
+    ----------
+    X : array
+        Centred data with shape (n_timepoints, n_trials, n_sources).
+    cov : array
+        Empirical covariance X^T X / n_trials with shape (n_timepoints, n_sources, n_sources).
+
+    Returns
+    -------
+    shrinkage : array
+        Shrinkage for each timepoint with shape (n_timepoints, ).
+    """
+    T, N, S = X.shape
+
+    X2 = X**2
+    emp_cov_trace = X2.sum(axis = 1) / N
+    mu = emp_cov_trace.sum(axis = 1) / S
+
+    beta_ = np.sum(X2.sum(axis = 2)**2, axis = 1)
+    delta_ = np.sum(cov**2, axis = (1, 2))
+
+    delta = (delta_ - 2 * mu * emp_cov_trace.sum(axis = 1) + S * mu**2) / S
+    beta = np.minimum((beta_ / N - delta_) / (S * N), delta)
+
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        return np.where(delta == 0, 0, beta / delta)
+
+
+def f_classif_batched(X, y):
+    """
+    ANOVA F-statistic of every source at every timepoint (same as sklearn.feature_selection.f_classif), computed in one pass.
+
+    Parameters
+    ----------
+    X : array
+        Data array with shape (n_timepoints, n_trials, n_sources).
+    y : array
+        Label array with shape (n_trials, ).
+
+    Returns
+    -------
+    F : array
+        F-statistics with shape (n_timepoints, n_sources).
+    """
+    classes, y_idx = np.unique(y, return_inverse = True)
+    n_classes, N = len(classes), len(y)
+
+    # class sums of the data and the squared data with one reduction over the trials
+    one_hot = np.zeros((N, n_classes))
+    one_hot[np.arange(N), y_idx] = 1
+    counts = one_hot.sum(axis = 0)
+
+    X = np.asarray(X, dtype = np.float64)
+    class_sums = np.einsum("tns,nc->tcs", X, one_hot)
+    total_sum = class_sums.sum(axis = 1)
+    total_sq = np.einsum("tns,tns->ts", X, X)
+
+    ss_total = total_sq - total_sum**2 / N
+    ss_between = np.einsum("tcs,c->ts", class_sums**2, 1 / counts) - total_sum**2 / N
+    ss_within = ss_total - ss_between
+
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        return (ss_between / (n_classes - 1)) / (ss_within / (N - n_classes))
+
+def top_k_features(F, k):
+    """
+    Indices of the k sources with the highest F-statistic at each timepoint, in the order SelectKBest keeps them.
+
+    Parameters
+    ----------
+    F : array
+        F-statistics with shape (n_timepoints, n_sources).
+    k : int
+        Number of sources to keep.
+
+    Returns
+    -------
+    features : array
+        Sorted source indices with shape (n_timepoints, k).
+    """
+    # SelectKBest treats NaN scores (constant sources) as the lowest possible score
+    F = np.where(np.isnan(F), np.finfo(F.dtype).min, F)
+
+    # stable sort so ties are broken as in SelectKBest
+    features = np.argsort(F, axis = 1, kind = "mergesort")[:, -k:]
+
+    return np.sort(features, axis = 1)
+
+
+@register_decoder("svc")
+def make_svc():
+    """
+    Standardisation and an RBF support vector classifier, fitted per timepoint.
+    """
+    return make_pipeline(StandardScaler(), svm.SVC(kernel = "rbf"))
+
+@register_decoder("ridge")
+def make_ridge(alpha = 1.0):
+    """
+    Batched ridge classifier.
+    """
+    return BatchedRidgeClassifier(alpha = alpha)
+
+@register_decoder("lda")
+def make_lda(shrinkage = None):
+    """
+    Batched shrinkage LDA.
+    """
+    return BatchedShrinkageLDA(shrinkage = shrinkage)
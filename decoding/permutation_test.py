@@ -0,0 +1,403 @@
+"""
+Usage, e.g., python permutation_test.py --contrast pos_neg --area mPFC --n_permutations 1000
+
+Cluster-based permutation test of the across subject decoding accuracies against chance (0.5).
+
+The labels are shuffled within each subject, and the same shuffled labels are used in all the leave-one-subject-out folds. The decoding is rerun for every permutation. At each timepoint, a one sample t-statistic of the accuracies against chance is calculated across subjects. The mass (sum of t-values) of the clusters of adjacent timepoints above the threshold is compared to the distribution of the largest cluster mass in each permutation.
+
+The defaults (svc decoder, K_FEATURES sources) are the settings of run_decoding.py, and the trials are chosen with the same seed (TRIAL_SEED), so the same trials are decoded. The observed accuracies are always recomputed with the original labels, so they and the permutations come from the same data. If results of run_decoding.py for the same contrast, area and settings are found in the results directory, the script reports whether they match the recomputed accuracies (e.g. they do not if they were saved before the trials were seeded).
+
+The part of the fit that does not depend on the labels is shared between the permutations. For the svc decoder, the standardisation is computed once per fold and timepoint, and only the feature selection and the SVC are refitted for every permutation. With the ridge decoder without feature selection (--k_features 0), the standardisation and solving the normal equations are computed once per fold, and the accuracies of many permutations are calculated with one matrix product (see ridge_test_projection in decoders.py).
+"""
+
+import numpy as np
+from pathlib import Path
+from scipy import stats
+from sklearn.base import clone
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+from joblib import Parallel, delayed
+import multiprocessing
+import argparse
+from tqdm import tqdm
+
+# local imports
+import sys
+sys.path.append(str(Path(__file__).parent))
+from decoders import DECODERS, get_decoder, BatchedRidgeClassifier, ridge_test_projection, f_classif_batched, top_k_features
+from run_decoding import SUBJECTS, TRIG_PAIRS, AREAS, K_FEATURES, results_file, load_subjects, stack_subjects, fold_indices, fit_score_timepoints, fit_score_batched, window_starts, expand_windows, ms_to_samples
+
+
+def permute_labels(y, bounds, n_permutations, seed = None):
+    """
+    Shuffles the labels within each subject.
+
+    Parameters
+    ----------
+    y : array
+        Label array for all subjects with shape (n_trials, ).
+    bounds : array
+        Array with the trial boundaries of the subjects as returned by stack_subjects.
+    n_permutations : int
+        Number of permutations.
+    seed : int, optional
+        Seed for the random number generator, by default None.
+
+    Returns
+    -------
+    Y : array
+        Array with shape (n_permutations + 1, n_trials). The first row has the original labels.
+    """
+    rng = np.random.default_rng(seed)
+
+    Y = np.tile(y, (n_permutations + 1, 1))
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        Y[1:, start:stop] = rng.permuted(Y[1:, start:stop], axis = 1)
+
+    return Y
+
+
+def ridge_permutation_scores(X, Y, train_idx, test_slice, alpha = 1.0, batch_size = 100):
+    """
+    Accuracies of the ridge classifier for all labellings in Y in one fold, with the label independent part of the fit shared between them.
+
+    Parameters
+    ----------
+    X : array
+        Time-major data array for all subjects with shape (n_timepoints, n_trials, n_sources).
+    Y : array
+        Labels with shape (n_labellings, n_trials) and two classes.
+    train_idx : array
+        Indices of the training trials.
+    test_slice : slice
+        Slice with the trials of the test subject.
+    alpha : float, optional
+        Regularisation strength, by default 1.0.
+    batch_size : int, optional
+        Number of labellings scored at once, by default 100.
+
+    Returns
+    -------
+    scores : array
+        Accuracy on the test trials with shape (n_labellings, n_timepoints).
+    """
+    H = ridge_test_projection(X[:, train_idx], X[:, test_slice], alpha)
+
+    # positive decision values predict the second class
+    is_second_class = Y == np.unique(Y[0])[1]
+
+    scores = np.zeros((len(Y), X.shape[0]))
+    for start in range(0, len(Y), batch_size):
+        batch = slice(start, start + batch_size)
+
+        targets = np.where(is_second_class[batch, train_idx], 1.0, -1.0)
+        target_mean = targets.mean(axis = 1)
+        targets -= target_mean[:, np.newaxis]
+
+        # decision function with shape (n_timepoints, n_test_trials, batch_size)
+        decision = H @ targets.T + target_mean
+        scores[batch] = np.mean((decision > 0) == is_second_class[batch, test_slice].T, axis = 1).T
+
+    return scores
+
+
+def standardised_permutation_scores(classifier, X, Y, train_idx, test_slice, features):
+    """
+    Accuracies of a classifier on standardised data for all labellings in Y in one fold.
+
+    The standardisation does not depend on the labels, so it is fitted on the training trials once per timepoint (as the StandardScaler in the svc pipeline would be) and shared between the labellings. Only the classifier is refitted for every labelling.
+
+    Parameters
+    ----------
+    classifier : sklearn estimator
+        Classifier to fit on the standardised data (e.g. the svc pipeline without the StandardScaler).
+    X : array
+        Time-major data array for all subjects with shape (n_timepoints, n_trials, n_sources).
+    Y : array
+        Labels with shape (n_labellings, n_trials).
+    train_idx : array
+        Indices of the training trials.
+    test_slice : slice
+        Slice with the trials of the test subject.
+    features : list
+        Sources to use at each timepoint for each labelling, arrays with shape (n_timepoints, k) as returned by top_k_features or None for all sources.
+
+    Returns
+    -------
+    scores : array
+        Accuracy on the test trials with shape (n_labellings, n_timepoints).
+    """
+    scores = np.zeros((len(Y), len(X)))
+
+    for t, X_t in enumerate(X):
+        Z_t = StandardScaler().fit(X_t[train_idx]).transform(X_t)
+        Z_train, Z_test = Z_t[train_idx], Z_t[test_slice]
+
+        for p, y in enumerate(Y):
+            sources = slice(None) if features[p] is None else features[p][t]
+            fitted = clone(classifier).fit(Z_train[:, sources], y[train_idx])
+            scores[p, t] = fitted.score(Z_test[:, sources], y[test_slice])
+
+    return scores
+
+
+def decoder_permutation_scores(decoder, X, Y, folds, k_features = None):
+    """
+    Accuracies of the decoder for all labellings in Y in all folds, refitting the decoder (and the feature selection) for every labelling.
+
+    If the decoder is a pipeline starting with a StandardScaler (e.g. svc), the standardisation is shared between the labellings, see standardised_permutation_scores.
+
+    Parameters
+    ----------
+    decoder : sklearn estimator or batched decoder
+        Decoder to use.
+    X : array
+        Time-major data array for all subjects with shape (n_timepoints, n_trials, n_sources).
+    Y : array
+        Labels with shape (n_labellings, n_trials).
+    folds : list
+        Training indices and test slices of the folds as returned by fold_indices.
+    k_features : int, optional
+        Number of sources to select at each timepoint. If None (default), all sources are used.
+
+    Returns
+    -------
+    scores : array
+        Accuracy with shape (n_labellings, n_subjects, n_timepoints).
+    """
+    T, _, S = X.shape
+    scores = np.zeros((len(Y), len(folds), T))
+
+    standardised = isinstance(decoder, Pipeline) and isinstance(decoder[0], StandardScaler)
+
+    for i, (train_idx, test_slice) in enumerate(folds):
+        # the sources are selected on the data before standardisation, as in across_subject
+        features = [None] * len(Y)
+        if k_features is not None and k_features < S:
+            X_train = X[:, train_idx]
+            features = [top_k_features(f_classif_batched(X_train, y[train_idx]), k_features) for y in Y]
+            del X_train
+
+        if standardised:
+            scores[:, i] = standardised_permutation_scores(decoder[1:], X, Y, train_idx, test_slice, features)
+            continue
+
+        for p, y in enumerate(Y):
+            if getattr(decoder, "batched", False):
+                scores[p, i] = fit_score_batched(clone(decoder), X, y, train_idx, test_slice, features[p])
+            else:
+                scores[p, i] = fit_score_timepoints(clone(decoder), X, y, train_idx, test_slice, np.arange(T), features[p])
+
+    return scores
+
+
+def permutation_scores(decoder, Xs, ys, n_permutations = 1000, k_features = None, window = 1, step = 1, n_jobs = 1, seed = None):
+    """
+    Runs the across subject decoding with the original labels and with labels shuffled within each subject.
+
+    Parameters
+    ----------
+    decoder : sklearn estimator or batched decoder
+        Decoder to use.
+    Xs : list
+        List of data arrays with shape (n_trials, n_sources, n_timepoints).
+    ys : list
+        List of label arrays with shape (n_trials, ).
+    n_permutations : int, optional
+        Number of permutations, by default 1000.
+    k_features : int, optional
+        Number of sources to select at each timepoint. If None (default), all sources are used.
+    window : int, optional
+        Number of timepoints averaged in each window, by default 1.
+    step : int, optional
+        Number of timepoints between the windows, by default 1.
+    n_jobs : int, optional
+        Number of processes to use, by default 1.
+    seed : int, optional
+        Seed for shuffling the labels, by default None.
+
+    Returns
+    -------
+    scores : array
+        Accuracy with shape (n_permutations + 1, n_subjects, n_timepoints). The first row has the accuracies with the original labels.
+    """
+    n_timepoints = Xs[0].shape[2]
+
+    X, y, bounds = stack_subjects(Xs, ys, window, step)
+    folds = [fold_indices(bounds, i) for i in range(len(Xs))]
+    Y = permute_labels(y, bounds, n_permutations, seed)
+
+    if isinstance(decoder, BatchedRidgeClassifier) and (k_features is None or k_features >= X.shape[2]):
+        # one job per fold, all permutations share the label independent part of the fit
+        scores = Parallel(n_jobs = min(n_jobs, len(folds)))(
+            delayed(ridge_permutation_scores)(X, Y, train_idx, test_slice, decoder.alpha)
+            for train_idx, test_slice in tqdm(folds, desc = "Leaving out data from subject for testing")
+            )
+        scores = np.stack(scores, axis = 1)
+
+    else:
+        # jobs with batches of permutations
+        batches = np.array_split(np.arange(len(Y)), min(len(Y), 4 * n_jobs))
+        scores = Parallel(n_jobs = n_jobs)(
+            delayed(decoder_permutation_scores)(decoder, X, Y[batch], folds, k_features)
+            for batch in tqdm(batches, desc = "Permutation batches")
+            )
+        scores = np.concatenate(scores, axis = 0)
+
+    if window > 1 or step > 1:
+        n_labellings, n_subjects, n_windows = scores.shape
+        scores = expand_windows(scores.reshape(-1, n_windows), window_starts(n_timepoints, window, step), window, n_timepoints)
+        scores = scores.reshape(n_labellings, n_subjects, n_timepoints)
+
+    return scores
+
+
+def t_statistic(scores, chance = 0.5):
+    """
+    One sample t-statistic of the accuracies against chance across subjects.
+
+    Parameters
+    ----------
+    scores : array
+        Accuracy with shape (..., n_subjects, n_timepoints).
+    chance : float, optional
+        Chance level, by default 0.5.
+
+    Returns
+    -------
+    t : array
+        Array with shape (..., n_timepoints). Timepoints where all subjects have the same accuracy get 0.
+    """
+    n_subjects = scores.shape[-2]
+    se = scores.std(axis = -2, ddof = 1) / np.sqrt(n_subjects)
+
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        t = (scores.mean(axis = -2) - chance) / se
+
+    return np.where(se > 0, t, 0)
+
+
+def find_clusters(t, threshold):
+    """
+    Finds the clusters of adjacent timepoints with t-values above the threshold.
+
+    Parameters
+    ----------
+    t : array
+        t-values with shape (n_timepoints, ).
+    threshold : float
+        Cluster forming threshold.
+
+    Returns
+    -------
+    clusters : list
+        List of (start, stop) tuples, the cluster is t[start:stop].
+    masses : array
+        Sum of the t-values in each cluster.
+    """
+    above = np.concatenate([[0], (t > threshold).astype(int), [0]])
+    changes = np.diff(above)
+    starts, stops = np.flatnonzero(changes == 1), np.flatnonzero(changes == -1)
+
+    masses = np.array([t[start:stop].sum() for start, stop in zip(starts, stops)])
+
+    return list(zip(starts, stops)), masses
+
+
+def cluster_permutation_test(scores, chance = 0.5, p_threshold = 0.05):
+    """
+    Cluster-mass permutation test of the accuracies against chance over time (one-sided, above chance).
+
+    Parameters
+    ----------
+    scores : array
+        Accuracy with shape (n_permutations + 1, n_subjects, n_timepoints) as returned by permutation_scores.
+    chance : float, optional
+        Chance level, by default 0.5.
+    p_threshold : float, optional
+        p-value of the one-sided t-test used as cluster forming threshold, by default 0.05.
+
+    Returns
+    -------
+    t_observed : array
+        t-values with the original labels with shape (n_timepoints, ).
+    clusters : list
+        List of (start, stop, mass, p-value) tuples for the clusters with the original labels.
+    max_masses : array
+        Largest cluster mass in each permutation with shape (n_permutations, ).
+    """
+    n_subjects = scores.shape[1]
+    threshold = stats.t.ppf(1 - p_threshold, df = n_subjects - 1)
+
+    t = t_statistic(scores, chance)
+
+    max_masses = np.zeros(len(scores) - 1)
+    for p, t_perm in enumerate(t[1:]):
+        _, masses = find_clusters(t_perm, threshold)
+        if len(masses) > 0:
+            max_masses[p] = masses.max()
+
+    clusters, masses = find_clusters(t[0], threshold)
+    clusters = [(start, stop, mass, (np.sum(max_masses >= mass) + 1) / (len(max_masses) + 1)) for (start, stop), mass in zip(clusters, masses)]
+
+    return t[0], clusters, max_masses
+
+
+if __name__ in "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--contrast", type=str, default="pos_neg", choices=list(TRIG_PAIRS), help="Contrast to decode")
+    parser.add_argument("--area", type=str, default="LIFG", choices=list(AREAS), help="Area to decode from")
+    parser.add_argument("--n_permutations", type=int, default=1000, help="Number of permutations")
+    parser.add_argument("--decoder", type=str, default="svc", choices=list(DECODERS), help="Decoder to use, default is svc as in run_decoding.py. Use ridge with --k_features 0 for a fast exploratory test, which shares the fits between the permutations")
+    parser.add_argument("--k_features", type=int, default=K_FEATURES, help=f"Number of sources to select at each timepoint, default is {K_FEATURES} as in run_decoding.py, 0 uses all sources. The selection is redone for every permutation")
+    parser.add_argument("--window_ms", type=float, default=None, help="Decode on the average of sliding windows of this length in ms, default is single samples")
+    parser.add_argument("--step_ms", type=float, default=None, help="Time between the decoded windows/samples in ms, default is every sample")
+    parser.add_argument("--p_threshold", type=float, default=0.05, help="Cluster forming threshold (p-value of the one-sided t-test against chance)")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for shuffling the labels")
+    parser.add_argument("--n_jobs", type=int, default=multiprocessing.cpu_count(), help="Number of processes to use, default is all available")
+    args = parser.parse_args()
+
+    path = Path(__file__).parent
+    data_path = path.parent / "data"
+    outpath = path / "results"
+
+    sfreq = 250 # sampling frequency of the epochs
+    tmin = -0.2 # start of the epochs in seconds
+    window = 1 if args.window_ms is None else ms_to_samples(args.window_ms, sfreq)
+    step = 1 if args.step_ms is None else ms_to_samples(args.step_ms, sfreq)
+
+    # create output directory if it doesn't exist
+    if not outpath.exists():
+        outpath.mkdir()
+
+    Xs, ys = load_subjects(data_path, SUBJECTS, AREAS[args.area], args.area, TRIG_PAIRS[args.contrast])
+
+    k_features = None if args.k_features == 0 else args.k_features
+
+    decoder = get_decoder(args.decoder)
+    scores = permutation_scores(decoder, Xs, ys, args.n_permutations, k_features, window, step, args.n_jobs, args.seed)
+
+    # the observed accuracies are recomputed from the same trials as the permutations, the saved results of run_decoding.py are only compared
+    saved_path = outpath / results_file(args.contrast, args.area, args.k_features, args.decoder, window, step, sfreq)
+    if k_features is not None and saved_path.exists():
+        saved = np.load(saved_path)
+        if saved.shape == scores[0].shape and np.allclose(saved, scores[0]):
+            print(f"The recomputed accuracies match the results in {saved_path}")
+        else:
+            print(f"WARNING: the recomputed accuracies differ from the results in {saved_path}, the clusters are for the recomputed accuracies. Rerun run_decoding.py to update the saved results")
+
+    t_observed, clusters, max_masses = cluster_permutation_test(scores, p_threshold = args.p_threshold)
+
+    print(f"Decoding {args.contrast} in {args.area} with {args.decoder}, {args.n_permutations} permutations")
+    for start, stop, mass, p in clusters:
+        print(f"Cluster {start / sfreq + tmin:.3f} to {(stop - 1) / sfreq + tmin:.3f} s: mass = {mass:.2f}, p = {p:.4f}")
+
+    k_suffix = "" if k_features is None else f"_{k_features}"
+    window_suffix = "" if window == 1 and step == 1 else f"_window{window * 1000 / sfreq:g}ms_step{step * 1000 / sfreq:g}ms"
+    np.savez(
+        outpath / f"permutation_test_{args.contrast}_area_{args.area}_{args.decoder}{k_suffix}{window_suffix}.npz",
+        scores = scores[0],
+        t = t_observed,
+        clusters = np.array(clusters).reshape(-1, 4),
+        max_masses = max_masses
+        )
@@ -3,28 +3,60 @@ X shape = (n_epochs, n_times, n_sources)
 """
 
 from pathlib import Path
+import json
 import numpy as np
-from sklearn import svm
-from sklearn.pipeline import make_pipeline
-from sklearn.preprocessing import StandardScaler
-from sklearn.feature_selection import SelectKBest
+from sklearn.base import clone
+from joblib import Parallel, delayed
 import multiprocessing
+import argparse
 from tqdm import tqdm
 
 # local imports
 import sys
 sys.path.append(str(Path(__file__).parents[1]))
-from utils import flip_sign, equalise_trials
+from utils import flip_sign, equalise_trials, save_atomic, save_concatenated
+from decoders import DECODERS, get_decoder, f_classif_batched, top_k_features
 
-def read_data(data_path, subject, x_file="X.npy", y_file="y.npy"):
+SUBJECTS = ["0108", "0109", "0110", "0111", "0112", "0113", "0114", "0115"]
+
+# triggers of the two classes for each contrast
+TRIG_PAIRS = {
+    "pos_neg": ([11, 21], [12, 22]),
+    "assigned_selfchosen": ([11, 12], [21, 22]),
+    "innerspeech_buttonpress": ([11, 21, 12, 22], [202])
+}
+
+# labels in each area
+AREAS = {
+    "LIFG": ['parsopercularis-lh','parsorbitalis-lh','parstriangularis-lh'],
+    "mPFC": ['superiorfrontal-rh']
+}
+
+# number of sources selected at each timepoint
+K_FEATURES = 150
+
+# seed for choosing the trials that are kept when balancing the classes and equalising the subjects, so run_decoding.py and permutation_test.py decode the same trials
+TRIAL_SEED = 2023
+
+def read_data(data_path, subject, x_file="X.npy", y_file="y.npy", mmap_mode="r", concat_file=None):
     """Read in data for a given subject.
 
+    The arrays are memory mapped, so only the trials that are used later on are read into memory. If several files are given, they are concatenated along the source axis.
+
     Parameters
     ----------
     data_path : str
         Path to the data directory.
     subject : str
         Subject ID.
+    x_file : str or list
+        File(s) with the data. Several files are concatenated along the source axis.
+    y_file : str or list
+        File(s) with the labels. Only the first file is read.
+    mmap_mode : str, optional
+        Memory map mode passed to np.load, by default "r". Use None to read the arrays into memory.
+    concat_file : str, optional
+        File to store the concatenated data in. The files it was concatenated from are recorded in a .json file next to it, and it is reused as long as it was made from the same files in x_file and is newer than them. If None (default), the files are concatenated in memory.
 
     Returns
     -------
@@ -33,24 +65,137 @@ def read_data(data_path, subject, x_file="X.npy", y_file="y.npy"):
     y : array
         Label array.
     """
-    if len(x_file) == 1:
-        X = np.load(data_path / subject / x_file[0])
-        y = np.load(data_path / subject / y_file[0])
+    if isinstance(x_file, str):
+        x_file = [x_file]
+    if isinstance(y_file, str):
+        y_file = [y_file]
+
+    subject_path = data_path / subject
+
+    # memory mapping only reads the headers
+    Xs = [np.load(subject_path / file_x, mmap_mode="r") for file_x in x_file]
+    print([X_part.shape for X_part in Xs])
+
+    y = np.load(subject_path / y_file[0])
+
+    if len(Xs) == 1:
+        X = np.load(subject_path / x_file[0], mmap_mode=mmap_mode)
     
-    else: # loop over files and concatenate
-        Xs = []
-        ys = []
+    elif concat_file is not None: # concatenate on disk once and reuse
+        concat_path = subject_path / concat_file
+        sidecar_path = concat_path.with_suffix(".json")
+        newest_part = max((subject_path / file_x).stat().st_mtime_ns for file_x in x_file)
 
-        for file_x in x_file:
-            print(np.load(data_path / subject / file_x).shape)
-            Xs.append(np.load(data_path / subject / file_x))
-        
-        y = np.load(data_path / subject / y_file[0])
-        X = np.concatenate(Xs, axis=1)
+        up_to_date = concat_path.exists() and sidecar_path.exists() and concat_path.stat().st_mtime_ns >= newest_part
+        if not up_to_date or json.loads(sidecar_path.read_text())["x_file"] != list(x_file):
+            save_concatenated(concat_path, Xs, axis=1)
+            save_atomic(sidecar_path, lambda tmp_path: tmp_path.write_text(json.dumps({"x_file": list(x_file)}, indent=4)))
+
+        X = np.load(concat_path, mmap_mode=mmap_mode)
+
+    else: # copy the files into one preallocated array
+        X = np.empty(concatenated_shape(Xs), dtype=Xs[0].dtype)
+        start = 0
+        for X_part in Xs:
+            X[:, start:start + X_part.shape[1]] = X_part
+            start += X_part.shape[1]
 
     return X, y
-    
-def balance_class_weights(X, y):
+
+def results_file(trig_label, area_label, k_features, decoder_name = "svc", window = 1, step = 1, sfreq = 250, prefix = "across_subjects"):
+    """
+    Name of the file the decoding results are saved in. The full resolution svc results keep the file names used by plot_results.py and t-test.py.
+
+    Parameters
+    ----------
+    trig_label : str
+        Name of the contrast.
+    area_label : str
+        Name of the area.
+    k_features : int
+        Number of sources selected at each timepoint.
+    decoder_name : str, optional
+        Name of the decoder, by default "svc".
+    window : int, optional
+        Number of timepoints averaged in each window, by default 1.
+    step : int, optional
+        Number of timepoints between the windows, by default 1.
+    sfreq : float, optional
+        Sampling frequency of the epochs, by default 250.
+    prefix : str, optional
+        Kind of decoding, "across_subjects" (default) or "temporal_generalisation".
+
+    Returns
+    -------
+    file_name : str
+        Name of the results file.
+    """
+    decoder_suffix = "" if decoder_name == "svc" else f"_{decoder_name}"
+    window_suffix = "" if window == 1 and step == 1 else f"_window{window * 1000 / sfreq:g}ms_step{step * 1000 / sfreq:g}ms"
+
+    return f"{prefix}_{trig_label}_area_{area_label}_{k_features}{decoder_suffix}{window_suffix}.npy"
+
+def concatenated_shape(Xs):
+    """
+    Shape of the arrays in Xs concatenated along axis 1.
+    """
+    return (Xs[0].shape[0], sum(X_part.shape[1] for X_part in Xs)) + Xs[0].shape[2:]
+
+def load_subjects(data_path, subjects, labels, area_label, trig_pair, seed = TRIAL_SEED):
+    """
+    Reads the data of all subjects for an area and prepares it for decoding a contrast: only the trials with the triggers in trig_pair are kept, the classes are balanced, the signs are flipped to match the first subject and the number of trials is equalised across subjects.
+
+    Parameters
+    ----------
+    data_path : Path
+        Path to the data directory.
+    subjects : list
+        Subject IDs.
+    labels : list
+        Labels in the area.
+    area_label : str
+        Name of the area, used for the file with the concatenated labels.
+    trig_pair : tuple
+        Lists with the triggers of the two classes.
+    seed : int, optional
+        Seed for choosing the trials that are kept, by default TRIAL_SEED. If None, different trials are chosen in every call.
+
+    Returns
+    -------
+    Xs : list
+        List of data arrays with shape (n_trials, n_sources, n_timepoints).
+    ys : list
+        List of label arrays with shape (n_trials, ) containing 0 and 1.
+    """
+    rng = np.random.default_rng(seed)
+
+    Xs = []
+    ys = []
+    # read in data for all subjects
+    for i, subject in enumerate(subjects):
+        files_x = [f"X_{label}.npy" for label in labels]
+        files_y = [f"y_{label}.npy" for label in labels]
+
+        print(f"reading data for subject {subject}")
+        print(f"reading files {files_x} and {files_y}")
+
+        X, y = read_data(data_path, subject, x_file=files_x, y_file=files_y, concat_file=f"X_area_{area_label}.npy")
+
+        # only keep data from certain triggers and convert y to zero and ones
+        X, y = keep_triggers(X, y, zero = trig_pair[0], one = trig_pair[1])
+
+        X, y = balance_class_weights(X, y, rng = rng)
+
+        if i != 0:
+            X = flip_sign(Xs[0], X)
+
+        Xs.append(X)
+        ys.append(y)
+
+    # make sure we keep an equal number of trials per participant
+    return equalise_trials(Xs, ys, rng = rng)
+
+def balance_class_weights(X, y, rng = None):
     """
     Balances the class weight by removing trials so each class has the same number of trials as the class with the least trials.
 
@@ -60,6 +205,8 @@ def balance_class_weights(X, y):
         Data array with shape (n_trials, x, x)
     y : array
         Array with shape (n_trials, ) containing several classes
+    rng : np.random.Generator, optional
+        Random number generator used to choose the trials, by default None (the global numpy random state)
 
     Returns
     -------
@@ -71,11 +218,12 @@ def balance_class_weights(X, y):
     """
     keys, counts = np.unique(y, return_counts = True)
 
+    rng = np.random if rng is None else rng
     keep_inds = []
 
     for key in keys:
         index = np.where(np.array(y) == key)
-        random_choices = np.random.choice(index[0], size = counts.min(), replace=False)
+        random_choices = rng.choice(index[0], size = counts.min(), replace=False)
         keep_inds.extend(random_choices)
     
     X_equal = X[keep_inds, :, :]
@@ -84,44 +232,347 @@ def balance_class_weights(X, y):
     return X_equal, y_equal
 
 
-def across_subject(decoder, Xs, ys):
+def window_starts(n_timepoints, window = 1, step = 1):
     """
-    Run decoding across subjects.
+    First timepoint of each of the windows used for decoding.
+
+    Parameters
+    ----------
+    n_timepoints : int
+        Number of timepoints.
+    window : int, optional
+        Number of timepoints averaged in each window, by default 1.
+    step : int, optional
+        Number of timepoints between the starts of the windows, by default 1.
+
+    Returns
+    -------
+    starts : array
+        Array with the first timepoint of each window.
+    """
+    return np.arange(0, n_timepoints - window + 1, step)
+
+
+def ms_to_samples(ms, sfreq = 250):
+    """
+    Converts a duration in milliseconds to a number of samples (at least 1).
+    """
+    return max(1, int(round(ms * sfreq / 1000)))
+
+
+def expand_windows(results, starts, window, n_timepoints):
+    """
+    Maps results for each window back to the timepoints. Each timepoint gets the result of the window with the nearest centre.
+
+    Parameters
+    ----------
+    results : array
+        Array with shape (n_subjects, n_windows) or (n_subjects, n_windows, n_windows).
+    starts : array
+        First timepoint of each window as returned by window_starts.
+    window : int
+        Number of timepoints in each window.
+    n_timepoints : int
+        Number of timepoints.
+
+    Returns
+    -------
+    results : array
+        Array with shape (n_subjects, n_timepoints) or (n_subjects, n_timepoints, n_timepoints).
+    """
+    centres = starts + (window - 1) / 2
+    nearest = np.argmin(np.abs(np.arange(n_timepoints)[:, np.newaxis] - centres[np.newaxis, :]), axis = 1)
+
+    results = results[:, nearest]
+    if results.ndim == 3:
+        results = results[:, :, nearest]
+
+    return results
+
+
+def stack_subjects(Xs, ys, window = 1, step = 1):
+    """
+    Stacks the data of all subjects into a single contiguous time-major array.
+
+    With window or step larger than 1, the timepoints are averaged in sliding windows (see window_starts) while stacking, so the data is never stacked at the full time resolution.
+
+    Parameters
+    ----------
+    Xs : list
+        List of data arrays with shape (n_trials, n_sources, n_timepoints).
+    ys : list
+        List of label arrays with shape (n_trials, ).
+    window : int, optional
+        Number of timepoints averaged in each window, by default 1.
+    step : int, optional
+        Number of timepoints between the starts of the windows, by default 1.
+
+    Returns
+    -------
+    X : array
+        Data array with shape (n_windows, n_trials_total, n_sources). Without windows, n_windows is n_timepoints.
+    y : array
+        Label array with shape (n_trials_total, ).
+    bounds : array
+        Array with shape (n_subjects + 1, ). The trials of subject i are X[:, bounds[i]:bounds[i + 1]].
+    """
+    bounds = np.cumsum([0] + [len(y_sub) for y_sub in ys])
+    N, S, T = bounds[-1], Xs[0].shape[1], Xs[0].shape[2]
+
+    if window == 1 and step == 1:
+        X = np.empty((T, N, S), dtype = Xs[0].dtype)
+        for i, X_sub in enumerate(Xs):
+            X[:, bounds[i]:bounds[i + 1], :] = X_sub.transpose(2, 0, 1)
+
+    else:
+        starts = window_starts(T, window, step)
+        X = np.empty((len(starts), N, S), dtype = Xs[0].dtype)
+        for i, X_sub in enumerate(Xs):
+            if window == 1: # strided timepoints
+                X[:, bounds[i]:bounds[i + 1], :] = X_sub[:, :, starts].transpose(2, 0, 1)
+            else:
+                for j, start in enumerate(starts):
+                    X[j, bounds[i]:bounds[i + 1], :] = X_sub[:, :, start:start + window].mean(axis = 2)
+
+    y = np.concatenate(ys, axis=0)
+
+    return X, y, bounds
+
+
+def fold_indices(bounds, i):
+    """
+    Gets the training indices and the test slice for the fold where subject i is left out.
+
+    Parameters
+    ----------
+    bounds : array
+        Array with the trial boundaries of the subjects as returned by stack_subjects.
+    i : int
+        Index of the subject to leave out.
+
+    Returns
+    -------
+    train_idx : array
+        Indices of the training trials (in subject order).
+    test_slice : slice
+        Slice with the trials of the test subject.
+    """
+    train_mask = np.ones(bounds[-1], dtype=bool)
+    train_mask[bounds[i]:bounds[i + 1]] = False
+
+    return np.flatnonzero(train_mask), slice(bounds[i], bounds[i + 1])
+
+
+def fit_score_timepoints(decoder, X, y, train_idx, test_slice, timepoints, features = None, generalise = False):
+    """
+    Fits the decoder on the training trials and scores it on the test trials, separately for each of the given timepoints.
+
+    With generalise, the model fitted at each timepoint is scored on the test trials of all timepoints, predicting the whole (n_timepoints * n_test_trials) block at once.
 
     Parameters
     ----------
     decoder : sklearn estimator
+        Unfitted decoder.
+    X : array
+        Time-major data array for all subjects with shape (n_timepoints, n_trials, n_sources).
+    y : array
+        Label array for all subjects with shape (n_trials, ).
+    train_idx : array
+        Indices of the training trials.
+    test_slice : slice
+        Slice with the trials of the test subject.
+    timepoints : array
+        Timepoints to fit and score.
+    features : array, optional
+        Sources to use at each of the timepoints with shape (n_timepoints_job, k) as returned by top_k_features. If None (default), all sources are used.
+    generalise : bool, optional
+        Whether to score the models on all timepoints, by default False.
+
+    Returns
+    -------
+    scores : list
+        Accuracy on the test trials for each timepoint. With generalise, arrays with the accuracy on each test timepoint.
+    """
+    n_features = X.shape[2] if features is None else features.shape[1]
+
+    # the training data is gathered into the same buffer for every timepoint
+    X_train = np.empty((len(train_idx), n_features), dtype = X.dtype)
+    y_train = y[train_idx]
+    y_test = y[test_slice]
+
+    if generalise:
+        X_test = X[:, test_slice]
+
+    scores = []
+    for j, t in enumerate(timepoints):
+        X_t = X[t] if features is None else X[t][:, features[j]]
+        np.take(X_t, train_idx, axis=0, out=X_train)
+        decoder.fit(X_train, y_train)
+
+        if generalise:
+            X_test_t = X_test if features is None else X_test[:, :, features[j]]
+            predictions = decoder.predict(X_test_t.reshape(-1, n_features)).reshape(X_test_t.shape[:2])
+            scores.append(np.mean(predictions == y_test, axis = 1))
+        else:
+            scores.append(decoder.score(X_t[test_slice], y_test))
+
+    return scores
+
+
+def fit_score_batched(decoder, X, y, train_idx, test_slice, features = None, generalise = False):
+    """
+    Fits a batched decoder on the training trials for all timepoints at once and scores it on the test trials.
+
+    With generalise, the model of each timepoint is scored on the test trials of all timepoints.
+
+    Parameters
+    ----------
+    decoder : batched decoder
+        Unfitted decoder (see decoders.py).
+    X : array
+        Time-major data array for all subjects with shape (n_timepoints, n_trials, n_sources).
+    y : array
+        Label array for all subjects with shape (n_trials, ).
+    train_idx : array
+        Indices of the training trials.
+    test_slice : slice
+        Slice with the trials of the test subject.
+    features : array, optional
+        Sources to use at each timepoint with shape (n_timepoints, k) as returned by top_k_features. If None (default), all sources are used.
+    generalise : bool, optional
+        Whether to score the models on all timepoints, by default False.
+
+    Returns
+    -------
+    scores : array
+        Accuracy on the test trials for each timepoint with shape (n_timepoints, ). With generalise, the shape is (n_timepoints, n_timepoints) with the training timepoints on the first axis.
+    """
+    X_selected = X if features is None else np.take_along_axis(X, features[:, np.newaxis, :], axis = 2)
+
+    decoder.fit(X_selected[:, train_idx], y[train_idx])
+
+    if generalise:
+        return decoder.score_generalisation(X[:, test_slice], y[test_slice], features)
+
+    return decoder.score(X_selected[:, test_slice], y[test_slice])
+
+
+def across_subject(decoder, Xs, ys, n_jobs = 1, k_features = None, generalise = False, window = 1, step = 1):
+    """
+    Run decoding across subjects.
+
+    The (left out subject, timepoints) fits are run as separate jobs, so they can be distributed across processes. The results are identical to fitting them one after the other. Batched decoders (see decoders.py) are fitted for all timepoints at once, with one job per left out subject.
+
+    If k_features is given, the k sources with the highest ANOVA F-statistic on the training trials are used at each timepoint (as SelectKBest in the decoder would). The F-statistics are computed for all timepoints of a fold at once before the fits.
+
+    With generalise, the model fitted at each timepoint is also scored on all other timepoints (temporal generalisation). The models are not refitted, so this costs little more than the diagonal.
+
+    With window or step larger than 1, the decoding is run on sliding-window averages or strided timepoints, and each timepoint gets the result of the window with the nearest centre, so the results have the same time axis as without windows.
+
+    Parameters
+    ----------
+    decoder : sklearn estimator or batched decoder
         Decoder to use.
     Xs : array
         Data array.
     ys : array
         Label array.
+    n_jobs : int, optional
+        Number of processes to use, by default 1
+    k_features : int, optional
+        Number of sources to select at each timepoint. If None (default), all sources are used.
+    generalise : bool, optional
+        Whether to run temporal generalisation, by default False.
+    window : int, optional
+        Number of timepoints averaged in each window, by default 1.
+    step : int, optional
+        Number of timepoints between the windows, by default 1.
 
     Returns
     -------
     results : array
-        Array with shape (n_subjects, n_timepoints) containing decoding results for each subject and timepoint.
+        Array with shape (n_subjects, n_timepoints) containing decoding results for each subject and timepoint. With generalise, the shape is (n_subjects, n_train_timepoints, n_test_timepoints).
     """
-    N, S, T = Xs[0].shape # ntrials, nsources, ntimepoints
-    results = np.zeros((len(Xs), T)) # number of subjects, number of time points
+    N, S, n_timepoints = Xs[0].shape # ntrials, nsources, ntimepoints
 
-    for i in tqdm(range(len(Xs)), desc = "Leaving out data from subject for testing"):
-        X_tmp = Xs.copy()
-        X_test = X_tmp.pop(i)
+    # stack all subjects once, the folds are expressed as indices into the trials
+    X, y, bounds = stack_subjects(Xs, ys, window, step)
+    T = X.shape[0] # number of windows
+    folds = [fold_indices(bounds, i) for i in range(len(Xs))]
 
-        y_tmp = ys.copy()
-        y_test = y_tmp.pop(i)
+    # the selected sources for all timepoints of each fold, shape (n_timepoints, k_features)
+    if k_features is not None and k_features < S:
+        features = [top_k_features(f_classif_batched(X[:, train_idx], y[train_idx]), k_features) for train_idx, _ in folds]
+    else:
+        features = [None] * len(folds)
 
-        X_train = np.concatenate(X_tmp, axis=0)
-        y_train = np.concatenate(y_tmp, axis=0)
+    if getattr(decoder, "batched", False):
+        scores = Parallel(n_jobs = min(n_jobs, len(Xs)))(
+            delayed(fit_score_batched)(clone(decoder), X, y, train_idx, test_slice, features[i], generalise)
+            for i, (train_idx, test_slice) in enumerate(tqdm(folds, desc = "Leaving out data from subject for testing"))
+            )
+
+        results = np.array(scores)
+
+    else:
+        # split the timepoints into chunks so there are a few jobs per process
+        n_chunks = min(T, max(1, int(np.ceil(4 * n_jobs / len(Xs)))))
+        jobs = [(i, timepoints) for i in range(len(Xs)) for timepoints in np.array_split(np.arange(T), n_chunks)]
+
+        # the arrays are shared read-only between the processes (memory mapped by joblib)
+        scores = Parallel(n_jobs = n_jobs)(
+            delayed(fit_score_timepoints)(clone(decoder), X, y, folds[i][0], folds[i][1], timepoints, None if features[i] is None else features[i][timepoints], generalise)
+            for i, timepoints in tqdm(jobs, desc = "Leaving out data from subject for testing (subject, timepoints)")
+            )
+
+        results = np.zeros((len(Xs), T, T) if generalise else (len(Xs), T)) # number of subjects, number of time points (train, test)
+        for (i, timepoints), scores_job in zip(jobs, scores):
+            results[i, timepoints] = scores_job
+
+    if window > 1 or step > 1:
+        results = expand_windows(results, window_starts(n_timepoints, window, step), window, n_timepoints)
 
-        for t in tqdm(range(T), desc = "timepoint"):
-            decoder.fit(X_train[:, :, t], y_train)
-            results[i, t] = decoder.score(X_test[:, :, t], y_test)
-    
     return results
 
 
+def remap_triggers(X, y, mapping):
+    """
+    Only keeps the trials with triggers in mapping and converts the triggers to class labels.
+
+    Parameters
+    ----------
+    X : array
+        Array with shape (n_trials, , )
+    y : array
+        Array with shape (n_trials, ) containing triggers.
+    mapping : dict
+        Dictionary mapping triggers to non-negative integer class labels. Several triggers can map to the same class.
+    
+    Returns
+    -------
+    X : array
+        Array with shape (n_kept_trials, , )
+    y : array
+        Array with shape (n_kept_trials, ) containing the class labels, using the smallest integer dtype that fits them.
+    """
+    triggers = np.array(list(mapping.keys()), dtype=int)
+    classes = np.array(list(mapping.values()), dtype=int)
+
+    if np.any(triggers < 0) or np.any(classes < 0):
+        raise ValueError("Triggers and class labels need to be non-negative integers")
+
+    y = np.asarray(y).astype(int)
+
+    # lookup table from trigger to class, -1 for triggers that are not kept
+    lookup = np.full(max(triggers.max(), y.max()) + 1, -1, dtype=int)
+    lookup[triggers] = classes
+
+    y_classes = lookup[y]
+    keep_idx = np.flatnonzero(y_classes >= 0)
+
+    return X[keep_idx], y_classes[keep_idx].astype(np.min_scalar_type(classes.max()))
+
+
 def keep_triggers(X, y, zero = [], one = []):
     """
     Only keeps specified triggers and converts them to 0 and 1.
@@ -138,88 +589,50 @@ def keep_triggers(X, y, zero = [], one = []):
     X : array
         Array with shape (n_trials, , )
     y : array
-        Array with shape (n_trials, ) containing 0 and 1.
+        Array with shape (n_trials, ) containing 0 and 1 (integers).
     """
-    # only keep certain triggers
-    trigger_idx = np.where(np.isin(y, zero + one))
-
-    X = X[trigger_idx[0], :, :]
-    y = y[trigger_idx[0]]
-
-
-    y_new = np.zeros(len(y))
+    mapping = {trigger: 0 for trigger in zero}
+    mapping.update({trigger: 1 for trigger in one})
 
-    for i in range(len(y)):
-        if y[i] in zero:
-            y_new[i] = 0
-        elif y[i] in one:
-            y_new[i] = 1
-    
-    return X, y_new
+    return remap_triggers(X, y, mapping)
 
 
 
 if __name__ in "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_jobs", type=int, default=multiprocessing.cpu_count(), help="Number of processes to use for the decoding, default is all available")
+    parser.add_argument("--decoder", type=str, default="svc", choices=list(DECODERS), help="Decoder to use, default is svc. The batched linear decoders (ridge, lda) fit all timepoints at once and are much faster for exploratory runs")
+    parser.add_argument("--temporal_generalisation", action="store_true", help="Score the decoder trained at each timepoint on all timepoints, saving (n_subjects, n_timepoints, n_timepoints) arrays")
+    parser.add_argument("--window_ms", type=float, default=None, help="Decode on the average of sliding windows of this length in ms, default is single samples")
+    parser.add_argument("--step_ms", type=float, default=None, help="Time between the decoded windows/samples in ms, default is every sample. The results are mapped back to every sample")
+    args = parser.parse_args()
 
     path = Path(__file__).parent
 
     data_path = path.parent / "data"
     outpath = path / "results"
-    trig_pairs_labels = ["pos_neg", "assigned_selfchosen", "innerspeech_buttonpress"]
-    trig_pairs = [([11, 21], [12, 22]), ([11, 12], [21, 22]), ([11, 21, 12, 22], [202])]
-
-    area_labels = ["LIFG", "mPFC"]
-    labels_area_1 = ['parsopercularis-lh','parsorbitalis-lh','parstriangularis-lh']
-    labels_area_2 = ['superiorfrontal-rh']
-
-    k_features = 150
 
+    sfreq = 250 # sampling frequency of the epochs
+    window = 1 if args.window_ms is None else ms_to_samples(args.window_ms, sfreq)
+    step = 1 if args.step_ms is None else ms_to_samples(args.step_ms, sfreq)
 
     # create output directory if it doesn't exist
     if not outpath.exists():
         outpath.mkdir()
-                
-    subjects = ["0108", "0109", "0110", "0111", "0112", "0113", "0114", "0115"] 
 
-    for idx_trig, trig_pair in enumerate(trig_pairs):
-        print(f"Running decoding for {trig_pairs_labels[idx_trig]}")
+    for trig_label, trig_pair in TRIG_PAIRS.items():
+        print(f"Running decoding for {trig_label}")
         print(f"Triggers are {trig_pair[0]} and {trig_pair[1]}")
         
-        for idx_area, area in enumerate([labels_area_1, labels_area_2]):
+        for idx_area, (area_label, area) in enumerate(AREAS.items()):
             print(f"Running decoding for {area}, which is in area {idx_area + 1}")
-            Xs = []
-            ys = []
-            # read in data for all subjects
-            for i, subject in enumerate(subjects):
-                files_x = [f"X_{label}.npy" for label in area]
-                files_y = [f"y_{label}.npy" for label in area]
-
-                
-                print(f"reading data for subject {subject}")
-                print(f"reading files {files_x} and {files_y}")
-
-                X, y = read_data(data_path, subject, x_file=files_x, y_file=files_y)
-
-
-                # only keep data from certain triggers and convert y to zero and ones
-                X, y = keep_triggers(X, y, zero = trig_pair[0], one = trig_pair[1])
-
-                X, y = balance_class_weights(X, y)
-                
-
-                if i != 0:
-                    X = flip_sign(Xs[0], X)
-
-                Xs.append(X)
-                ys.append(y)
-
+            Xs, ys = load_subjects(data_path, SUBJECTS, area, area_label, trig_pair)
 
-            # make sure we keep an equal number of trials per participant
-            Xs, ys = equalise_trials(Xs, ys)
             # run decoding
-            decoder = make_pipeline(StandardScaler(), SelectKBest(k=k_features), svm.SVC(kernel = "rbf"))
+            decoder = get_decoder(args.decoder)
 
             # run across subject decoding
-            results = across_subject(decoder, Xs, ys)
+            results = across_subject(decoder, Xs, ys, n_jobs = args.n_jobs, k_features = K_FEATURES, generalise = args.temporal_generalisation, window = window, step = step)
             # save results
-            np.save(outpath / f"across_subjects_{trig_pairs_labels[idx_trig]}_area_{area_labels[idx_area]}_{k_features}.npy", results)
+            prefix = "temporal_generalisation" if args.temporal_generalisation else "across_subjects"
+            np.save(outpath / results_file(trig_label, area_label, K_FEATURES, args.decoder, window, step, sfreq, prefix), results)
@@ -0,0 +1,105 @@
+'''
+Usage, e.g., python benchmark_ica.py --subject 0114 --recording 001.self_block1
+
+Benchmarks the options for speeding up ICA fitting in run_ica.py on a single recording:
+    1) Fitting on all samples (as done by default)
+    2) Fitting on decimated data (every decim sample)
+    3) Warm-starting FastICA from the ICA solution saved in the ICA folder (or from the fit in 1 if there is none)
+
+For every fit the number of components, FastICA iterations and fit time are reported, together with how well the components match the reference solution (the saved ICA solution if there is one, otherwise the fit in 1). The components are matched by the absolute correlation of their sensor topographies. As the noise components in 'session_info.txt' refer to the saved ICA solution, their best match is reported as well.
+'''
+
+import argparse
+import json
+import sys
+import numpy as np
+import mne
+from pathlib import Path
+from scipy.optimize import linear_sum_assignment
+
+# local imports
+sys.path.append(str(Path(__file__).parent))
+from run_ica import prepare_raw_for_ICA, fit_ICA
+
+def match_components(ica_ref, ica):
+    """
+    Matches the components of two ICA solutions by the absolute correlation of their topographies.
+
+    Parameters
+    ----------
+    ica_ref : mne.preprocessing.ICA
+        Reference ICA solution.
+    ica : mne.preprocessing.ICA
+        ICA solution to match to the reference.
+
+    Returns
+    -------
+    matches : dict
+        Dictionary with the components of ica_ref as keys and tuples with the matched component of ica and the absolute correlation as values.
+    """
+    # only compare the channels that are in both solutions
+    ch_names = [ch for ch in ica_ref.ch_names if ch in ica.ch_names]
+    patterns_ref = ica_ref.get_components()[[ica_ref.ch_names.index(ch) for ch in ch_names]]
+    patterns = ica.get_components()[[ica.ch_names.index(ch) for ch in ch_names]]
+
+    n_ref = patterns_ref.shape[1]
+    corr = np.abs(np.corrcoef(patterns_ref.T, patterns.T)[:n_ref, n_ref:])
+
+    # assignment maximising the total correlation
+    rows, cols = linear_sum_assignment(corr, maximize=True)
+
+    return {row: (col, corr[row, col]) for row, col in zip(rows, cols)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--subject", type=str, default="0114", help="Subject ID")
+    parser.add_argument("--recording", type=str, default="001.self_block1", help="Name of the recording")
+    parser.add_argument("--decims", type=int, nargs="*", default=[2, 4], help="Decimation factors to benchmark")
+    parser.add_argument("--n_jobs", type=int, default=1, help="Number of threads to use for filtering and resampling")
+    args = parser.parse_args()
+
+    path = Path(__file__)
+    ICA_path = path.parents[1] / "ICA"
+    MEG_data_path = Path("/work/834761")
+
+    # load session information with bad channels and cropping times
+    with open(path.parents[1] / 'session_info.txt', 'r') as f:
+        session_info = json.load(f)
+
+    subject_session_info = session_info[args.subject][args.recording]
+
+    # find the folder with MEG data and not the folder with MRI data
+    subject_meg_path = list((MEG_data_path / args.subject).glob("*_000000"))[0]
+    fif_file_path = list((subject_meg_path / "MEG" / args.recording / "files").glob("*.fif"))[0]
+
+    raw = prepare_raw_for_ICA(fif_file_path, subject_session_info["bad_channels"], subject_session_info["tmin"], subject_session_info["tmax"], args.n_jobs)
+
+    fits = {}
+    fits["all samples"] = fit_ICA(raw)
+
+    for decim in args.decims:
+        fits[f"decim {decim}"] = fit_ICA(raw, decim=decim)
+
+    saved_path = ICA_path / args.subject / f"{args.recording}-ica.fif"
+    if saved_path.exists():
+        ica_ref = mne.preprocessing.read_ica(saved_path)
+        ref_name = "saved solution"
+    else:
+        ica_ref = fits["all samples"][0]
+        ref_name = "all samples"
+
+    fits["warm start"] = fit_ICA(raw, warm_start_ica=ica_ref)
+
+    print(f"Subject {args.subject}, recording {args.recording}, components matched to the {ref_name}")
+    for name, (ica, fit_time) in fits.items():
+        matches = match_components(ica_ref, ica)
+        corrs = np.array([corr for _, corr in matches.values()])
+
+        print(f"{name}: {ica.n_components_} components, {ica.n_iter_} iterations, {fit_time:.1f} s, matched |r| mean {corrs.mean():.3f}, min {corrs.min():.3f}")
+
+        if ref_name == "saved solution":
+            for component in subject_session_info["noise_components"]:
+                if component in matches:
+                    match, corr = matches[component]
+                    print(f"    noise component {component} -> {match} (|r| = {corr:.3f})")
@@ -25,7 +25,7 @@ if not os.path.exists("/tmp/mne-cache"):
 
 # local imports
 sys.path.append(str(Path(__file__).parents[1]))
-from utils import preprocess_data_sensorspace, epochs_to_sourcespace, morph_stcs_label
+from utils import preprocess_data_sensorspace, epochs_to_sourcespace, morph_stcs_labels, epochs_to_labels, run_jobs_parallel, file_fingerprint, save_atomic, save_concatenated, digest
 
 def sanitize_label_for_filename(label: str) -> str:
     """
@@ -42,18 +42,272 @@ def sanitize_label_for_filename(label: str) -> str:
 
     return re.sub(r"[^a-zA-Z0-9_\-]", "_", label)
 
+def completed_labels(checkpoint_dir:Path, fingerprint:str):
+    """
+    Finds the labels saved for a recording by write_checkpoint, if they were computed from the same inputs. Only the manifest is read.
+
+    Parameters
+    ----------
+    checkpoint_dir : Path
+        Directory with the checkpoint of the recording.
+    fingerprint : str
+        Fingerprint of the current inputs of the recording.
+    
+    Returns
+    -------
+    labels : list
+        List with the completed labels. Empty if the checkpoint is missing or stale.
+    """
+    manifest_path = checkpoint_dir / "manifest.json"
+
+    if not manifest_path.exists():
+        return []
+
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+
+    if manifest["fingerprint"] != fingerprint:
+        return []
+
+    return manifest["labels"]
+
+def load_checkpoint(checkpoint_dir:Path, labels:list):
+    """
+    Loads the data saved for a recording by write_checkpoint.
+
+    Parameters
+    ----------
+    checkpoint_dir : Path
+        Directory with the checkpoint of the recording.
+    labels : list
+        List of completed labels to load (see completed_labels).
+    
+    Returns
+    -------
+    X : dict
+        Dictionary with the labels as keys and the data as values.
+    y : np.array
+        Array with the triggers of the epochs.
+    """
+    X = {label: np.load(checkpoint_dir / f"X_{sanitize_label_for_filename(label)}.npy") for label in labels}
+    y = np.load(checkpoint_dir / "y.npy")
+
+    return X, y
+
+def write_checkpoint(checkpoint_dir:Path, fingerprint:str, X:dict, y:np.array):
+    """
+    Saves the data for a recording and adds the labels to the manifest of completed labels.
+
+    The arrays are written before the manifest, so the manifest only lists labels whose data is completely written.
+
+    Parameters
+    ----------
+    checkpoint_dir : Path
+        Directory with the checkpoint of the recording.
+    fingerprint : str
+        Fingerprint of the inputs of the recording.
+    X : dict
+        Dictionary with the labels as keys and the data as values.
+    y : np.array
+        Array with the triggers of the epochs.
+    """
+    checkpoint_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path = checkpoint_dir / "manifest.json"
+
+    # keep the labels that were already completed from the same inputs
+    completed = completed_labels(checkpoint_dir, fingerprint)
+
+    for label, X_label in X.items():
+        save_atomic(checkpoint_dir / f"X_{sanitize_label_for_filename(label)}.npy", np.save, X_label)
+    save_atomic(checkpoint_dir / "y.npy", np.save, y)
+
+    manifest = {"fingerprint": fingerprint, "labels": sorted(set(completed) | set(X.keys()))}
+    save_atomic(manifest_path, lambda tmp_path: tmp_path.write_text(json.dumps(manifest, indent=4)))
+
+def assemble_recordings(checkpoint_dirs:list, file:str, out_path:Path):
+    """
+    Concatenates an array saved for several recordings (by write_checkpoint) into a single .npy file.
+
+    The number of trials of each recording is read from the .npy headers first, so the output can be preallocated on disk and every recording is copied directly into its place, without holding more than one recording in memory.
+
+    Parameters
+    ----------
+    checkpoint_dirs : list
+        List with the checkpoint directories of the recordings, in the order to concatenate them in.
+    file : str
+        Name of the file in the checkpoint directories.
+    out_path : Path
+        Path to the .npy file to write.
+    
+    Returns
+    -------
+    shape : tuple
+        Shape of the concatenated array.
+    """
+    # memory mapping only reads the headers
+    parts = [np.load(checkpoint_dir / file, mmap_mode="r") for checkpoint_dir in checkpoint_dirs]
+
+    return save_concatenated(out_path, parts, axis=0)
+
+def process_recording(subject:str, recording_name:str, subject_info:dict, subject_meg_path:Path, ICA_path:Path, fs_subjects_dir:Path, labels:list, epochs_cache_dir:Path = None, full_source_estimates:bool = False, label_cache_file:Path = None, preload:bool = True, resample_raw:bool = False, checkpoint_dir:Path = None, resume:bool = False, return_data:bool = True, n_jobs:int = 4):
+    """
+    Preprocesses a single recording, projects it to source space, morphs it to fsaverage and extracts the data for all labels.
+
+    Parameters
+    ----------
+    subject : str
+        Subject ID.
+    recording_name : str
+        Name of the recording.
+    subject_info : dict
+        Session information for the subject.
+    subject_meg_path : Path
+        Path to the folder with the MEG data of the subject.
+    ICA_path : Path
+        Path to the folder with the ICA solutions.
+    fs_subjects_dir : Path
+        Path to the freesurfer subjects directory.
+    labels : list
+        List of regular expressions for the labels to extract.
+    epochs_cache_dir : Path, optional
+        Directory to cache the preprocessed epochs in. The default is None (no caching).
+    full_source_estimates : bool, optional
+        Whether to compute whole-cortex source estimates and morph them, instead of applying the combined inverse and morph operator for the labels only. The default is False.
+    label_cache_file : Path, optional
+        Path to a .npz file to persist the fsaverage label vertices in. The default is None.
+    preload : bool, optional
+        Whether to load the epochs into memory. If False, they are read one at a time when the noise covariance and source data are computed. The default is True.
+    resample_raw : bool, optional
+        Whether to resample the continuous raw data before filtering, applying ICA and epoching instead of resampling the epochs, see preprocess_data_sensorspace. The default is False.
+    checkpoint_dir : Path, optional
+        Directory to save the data of the recording in as soon as it is computed, see write_checkpoint. The default is None.
+    resume : bool, optional
+        Whether to reuse the data in checkpoint_dir for the labels that were completed from the same inputs (files, session info and options). The default is False.
+    return_data : bool, optional
+        Whether to return the data. If False (requires checkpoint_dir), nothing is returned and the data is only saved in checkpoint_dir, so it does not have to be sent back from a worker process. The default is True.
+    n_jobs : int, optional
+        Number of threads to use. The default is 4.
+    
+    Returns
+    -------
+    X : dict
+        Dictionary with the labels as keys and arrays with shape (n_epochs, n_vertices, n_times) as values. Only returned if return_data is True.
+    y : np.array
+        Array with the triggers of the epochs. Only returned if return_data is True.
+    """
+    if not return_data and checkpoint_dir is None:
+        raise ValueError("checkpoint_dir is needed when the data is not returned")
+
+    logging.basicConfig(level=logging.INFO)
+    logging.info(f"Processing subject {subject}, recording {recording_name}")
+    subject_session_info = subject_info[recording_name]
+
+    fif_file_path = list((subject_meg_path / "MEG" / recording_name / "files").glob("*.fif"))[0]
+
+    ICA_path_sub = ICA_path / subject / f"{recording_name}-ica.fif"
+
+    if 'self' in recording_name:
+        event_id = {
+            "img/self/positive": 11, 
+            "img/self/negative": 12,
+            "button": 202}
+    elif 'other' in recording_name: 
+        event_id = {
+            "img/assigned/positive": 21, 
+            "img/assigned/negative": 22,
+            "button": 202}
+
+    # load forward solution
+    fwd_fname = recording_name[4:] + '-oct-6-src-' + '5120-fwd.fif'
+    fwd_path = fs_subjects_dir / subject / 'bem' / fwd_fname
+
+    morph_subject_path = fs_subjects_dir / subject / "bem" / f"{subject}-oct-6-src-morph.h5"
+
+    # identifies all inputs the data of the recording depends on
+    fingerprint = {
+        "fif": file_fingerprint(fif_file_path),
+        "ica": file_fingerprint(ICA_path_sub),
+        "fwd": file_fingerprint(fwd_path),
+        "morph": file_fingerprint(morph_subject_path),
+        "reject": subject_info["reject"],
+        "session_info": subject_session_info,
+        "event_id": event_id,
+        "full_source_estimates": full_source_estimates,
+        "preload": preload,
+        "resample_raw": resample_raw,
+        # bumped when the extracted data changes, 2: right hemisphere labels read from the right hemisphere
+        "version": 2
+    }
+    fingerprint = digest(fingerprint)
+
+    # only the manifest is read to decide what to compute, the data is only loaded if it is returned
+    completed = []
+    if resume and checkpoint_dir is not None:
+        completed = [label for label in labels if label in completed_labels(checkpoint_dir, fingerprint)]
+
+    missing_labels = [label for label in labels if label not in completed]
+    if not missing_labels:
+        logging.info(f"Using checkpoint for subject {subject}, recording {recording_name}")
+        return load_checkpoint(checkpoint_dir, completed) if return_data else None
+
+    epochs = preprocess_data_sensorspace(
+        fif_path = fif_file_path, 
+        bad_channels = subject_session_info["bad_channels"], 
+        reject = subject_info["reject"], 
+        ica_path = ICA_path_sub, 
+        noise_components = subject_session_info["noise_components"], 
+        event_ids=event_id,
+        tmin = -0.2,
+        tmax = 1,
+        preload=preload,
+        resample_raw=resample_raw,
+        n_jobs=n_jobs,
+        cache_dir=epochs_cache_dir)
+
+    fwd = mne.read_forward_solution(fwd_path)
+
+    if full_source_estimates:
+        # get source time courses
+        stcs = epochs_to_sourcespace(epochs, fwd, fwd_path=fwd_path)
+
+        # morph from subject to fsaverage once and slice out all labels
+        X_new = morph_stcs_labels(morph_subject_path, stcs, fs_subjects_dir, missing_labels, label_cache_file=label_cache_file)
+    else:
+        # project directly to the fsaverage vertices of the labels
+        X_new = epochs_to_labels(epochs, fwd, morph_subject_path, fs_subjects_dir, missing_labels, label_cache_file=label_cache_file, fwd_path=fwd_path)
+    y = epochs.events[:, -1]
+
+    if checkpoint_dir is not None:
+        write_checkpoint(checkpoint_dir, fingerprint, X_new, y)
+
+    if not return_data:
+        return None
+
+    X = load_checkpoint(checkpoint_dir, completed)[0] if completed else {}
+    X.update(X_new)
+
+    return X, y
+
 def main():
     logging.basicConfig(level=logging.INFO)
 
     parser = argparse.ArgumentParser()
     parser.add_argument("--num_cpu", type=int, default=multiprocessing.cpu_count(), help="Number of CPUs to use, default is all available")
-    parser.add_argument("--parcel_regex", type=str, nargs="*", default=["superiorfrontal-lh|superiorfrontal-rh"], help="Regular expression for the parcels to include")
+    parser.add_argument("--n_workers", type=int, default=1, help="Number of recordings to process in parallel, the CPUs are split between them. Default is 1")
+    parser.add_argument("--parcel_regex", type=str, nargs="*", default=["parsopercularis-lh", "parsorbitalis-lh", "parstriangularis-lh", "superiorfrontal-rh"], help="Regular expressions for the parcels to include, each is saved to its own file")
     parser.add_argument("--all_parcels", default=False, action="store_true", help="Whether to include all parcels (ignores parcel_regex)")
+    parser.add_argument("--full_source_estimates", default=False, action="store_true", help="Compute whole-cortex source estimates and morph them instead of projecting directly to the labels")
+    parser.add_argument("--lazy_epochs", default=False, action="store_true", help="Do not load the epochs into memory (decimates instead of resampling), lowers the peak memory use per recording")
+    parser.add_argument("--resample_raw", default=False, action="store_true", help="Resample the continuous raw data before filtering, ICA and epoching instead of resampling the epochs, check the effect with sanity_checks/check_early_resample.py")
+    parser.add_argument("--resume", default=False, action="store_true", help="Reuse the per-recording checkpoints that were computed from the same inputs, only recordings and labels that are missing or stale are computed")
+    parser.add_argument("--no_epochs_cache", default=False, action="store_true", help="Do not read or write preprocessed epochs from the epochs cache")
     args = parser.parse_args()
     
     num_cpu = args.num_cpu
-    os.environ["OMP_NUM_THREADS"] = str(num_cpu)
-    logging.info(f"Using {num_cpu} CPUs")
+    n_workers = min(args.n_workers, num_cpu)
+    threads_per_job = max(1, num_cpu // n_workers)
+    os.environ["OMP_NUM_THREADS"] = str(threads_per_job)
+    logging.info(f"Using {num_cpu} CPUs, {n_workers} workers with {threads_per_job} threads each")
     
     path = Path(__file__).parents[1]
 
@@ -62,96 +316,70 @@ def main():
     subjects = ["0108", "0109", "0110", "0111", "0112", "0113", "0114", "0115"]
     recording_names = ['001.self_block1',  '002.other_block1', '003.self_block2', '004.other_block2', '005.self_block3', '006.other_block3']
     outpath = path / "data"
-    fwd_fsaverage_path = fs_subjects_dir / "fsaverage" / "bem" / "fsaverage-oct-6-src.fif"
     ICA_path = path / "ICA"
+    epochs_cache_dir = None if args.no_epochs_cache else path / "epochs_cache"
 
-    labels = ["parsopercularis-lh", "parsorbitalis-lh", "parstriangularis-lh", "superiorfrontal-rh"]
     # load session information with reject criterion
     with open(path / 'session_info.txt', 'r') as f:
         file = f.read()
         session_info = json.loads(file)
     
-    # load src for fsaverage
-    src_fsaverage = mne.read_source_spaces(fwd_fsaverage_path)
-
-    for label in labels:
-        logging.info(f"Processing label {label}")
-        for subject in subjects:
-            logging.info(f"Processing subject {subject}")
-            subject_info = session_info[subject]
-            subject_path = MEG_data_path / subject
-            
-            # find the folder with MEG data and not the folder with MRI data
-            subject_meg_path = list(subject_path.glob("*_000000"))[0]
-
-            # make a folder for the subject
-            subject_outpath = outpath / subject
-
-            if not subject_outpath.exists():
-                subject_outpath.mkdir(parents=True)
-
-            for idx, recording_name in enumerate(recording_names):
-                logging.info(f"Processing recording {recording_name}")
-                subject_session_info = subject_info[recording_name]
-
-                fif_file_path = list((subject_meg_path / "MEG" / recording_name / "files").glob("*.fif"))[0]
-
-                ICA_path_sub = ICA_path / subject / f"{recording_name}-ica.fif"
-
-                if 'self' in recording_name:
-                    event_id = {
-                        "img/self/positive": 11, 
-                        "img/self/negative": 12,
-                        "button": 202}
-                elif 'other' in recording_name: 
-                    event_id = {
-                        "img/assigned/positive": 21, 
-                        "img/assigned/negative": 22,
-                        "button": 202}
-
-                epochs = preprocess_data_sensorspace(
-                    fif_path = fif_file_path, 
-                    bad_channels = subject_session_info["bad_channels"], 
-                    reject = subject_info["reject"], 
-                    ica_path = ICA_path_sub, 
-                    noise_components = subject_session_info["noise_components"], 
-                    event_ids=event_id,
-                    tmin = -0.2,
-                    tmax = 1,
-                    n_jobs=num_cpu)
-
-                # load forward solution
-                fwd_fname = recording_name[4:] + '-oct-6-src-' + '5120-fwd.fif'
-                fwd = mne.read_forward_solution(fs_subjects_dir / subject / 'bem' / fwd_fname)
-
-                # get source time courses
-                stcs = epochs_to_sourcespace(epochs, fwd, n_jobs=num_cpu)
-
-                # morph from subject to fsaverage
-                morph_subject_path = fs_subjects_dir / subject / "bem" / f"{subject}-oct-6-src-morph.h5"
-                
-                X_tmp = morph_stcs_label(morph_subject_path, stcs, fs_subjects_dir, label)
-                y_tmp = epochs.events[:, -1]
-
-                if idx == 0:
-                    X = X_tmp
-                    y = y_tmp
-                else:
-                    X = np.concatenate((X, X_tmp))
-                    y = np.concatenate((y, y_tmp))
-
-            print(X.shape)
-            print(y.shape)
-            
-            # save the data
+    if args.all_parcels:
+        labels = [label.name for label in mne.read_labels_from_annot("fsaverage", parc="aparc", subjects_dir=fs_subjects_dir)]
+    else:
+        labels = args.parcel_regex
+    logging.info(f"Extracting labels {labels}")
+
+    outpath.mkdir(parents=True, exist_ok=True)
+
+    # one job per subject and recording
+    jobs = []
+    for subject in subjects:
+        subject_path = MEG_data_path / subject
+        
+        # find the folder with MEG data and not the folder with MRI data
+        subject_meg_path = list(subject_path.glob("*_000000"))[0]
+
+        for recording_name in recording_names:
+            jobs.append({
+                "subject": subject,
+                "recording_name": recording_name,
+                "subject_info": session_info[subject],
+                "subject_meg_path": subject_meg_path,
+                "ICA_path": ICA_path,
+                "fs_subjects_dir": fs_subjects_dir,
+                "labels": labels,
+                "epochs_cache_dir": epochs_cache_dir,
+                "full_source_estimates": args.full_source_estimates,
+                "label_cache_file": outpath / "label_vertices.npz",
+                "preload": not args.lazy_epochs,
+                "resample_raw": args.resample_raw,
+                "checkpoint_dir": outpath / subject / "checkpoints" / recording_name,
+                "resume": args.resume})
+
+    # the data is saved in the checkpoints and read from there when assembling the outputs
+    run_jobs_parallel(process_recording, [{**job, "return_data": False} for job in jobs], n_workers = n_workers, threads_per_job = threads_per_job)
+
+    for subject in subjects:
+        # checkpoints for the recordings of the subject in recording order
+        checkpoint_dirs = [job["checkpoint_dir"] for job in jobs if job["subject"] == subject]
+
+        # make a folder for the subject
+        subject_outpath = outpath / subject
+
+        if not subject_outpath.exists():
+            subject_outpath.mkdir(parents=True)
+
+        # save the data
+        for label in labels:
             sanitized_label = sanitize_label_for_filename(label)
             logging.info(f"Saving data for label {sanitized_label}")
             X_path = subject_outpath / f"X_{sanitized_label}.npy"
             logging.info(f"Saving X data to {X_path}")
             y_path = subject_outpath / f"y_{sanitized_label}.npy"
             logging.info(f"Saving y data to {y_path}")
-            np.save(X_path, X)
-            np.save(y_path, y)
+            print(assemble_recordings(checkpoint_dirs, f"X_{sanitized_label}.npy", X_path))
+            print(assemble_recordings(checkpoint_dirs, "y.npy", y_path))
 
 
 if __name__ in "__main__":
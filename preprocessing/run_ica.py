@@ -11,60 +11,212 @@ The script saves the ICA to a file. Unwanted components are manually detected an
 '''
 
 import argparse
+import multiprocessing
 import mne
+import numpy as np
 import json
+import time
+import sys
 from pathlib import Path
 
-def run_ICA_on_session(filepath:Path, outpath:Path, bad_channels:list, tmin:float, tmax:float):
+# local imports
+sys.path.append(str(Path(__file__).parents[1]))
+from utils import run_jobs_parallel, file_fingerprint, digest
+
+def ica_fingerprint(filepath:Path, bad_channels:list, tmin:float, tmax:float, decim:int = None):
     """
-    Runs ICA on a single session and saves the ICA solution to a file.
+    Fingerprint of the inputs of an ICA solution (raw file and session information), used to check whether a saved ICA is up to date.
 
     Parameters
     ----------
     filepath : Path
         Path to the raw fif file.
-    outpath : Path
-        Path to save the ICA solution to.
     bad_channels : list
         List of channels to mark as bad.
     tmin : float
         Start time of the recording (in seconds).
     tmax : float
         End time of the recording (in seconds).
+    decim : int, optional
+        Decimation used when fitting the ICA. Only part of the fingerprint if the data is actually decimated. The default is None.
+
+    Returns
+    -------
+    fingerprint : str
+        Hex digest identifying the inputs.
+    """
+    fingerprint = {
+        "raw": file_fingerprint(filepath),
+        "bad_channels": bad_channels,
+        "tmin": tmin,
+        "tmax": tmax
+    }
+
+    # without decimation the fingerprint stays the same as before decim was added, so existing ICA solutions are still up to date
+    if decim not in (None, 1):
+        fingerprint["decim"] = decim
+
+    return digest(fingerprint)
+
+def ica_is_up_to_date(outpath:Path, fingerprint:str):
+    """
+    Checks whether the ICA solution in outpath was fitted from inputs with the given fingerprint (stored in the .json file next to it by run_ICA_on_session).
+    """
+    info_path = outpath.with_suffix(".json")
+
+    if not outpath.exists() or not info_path.exists():
+        return False
+
+    with open(info_path, 'r') as f:
+        return json.load(f).get("fingerprint") == fingerprint
+
+def prepare_raw_for_ICA(filepath:Path, bad_channels:list, tmin:float, tmax:float, n_jobs:int = 1):
+    """
+    Loads, crops, filters and resamples a recording for fitting ICA.
+
+    Parameters
+    ----------
+    filepath : Path
+        Path to the raw fif file.
+    bad_channels : list
+        List of channels to mark as bad.
+    tmin : float
+        Start time of the recording (in seconds).
+    tmax : float
+        End time of the recording (in seconds).
+    n_jobs : int, optional
+        Number of threads to use for filtering and resampling. The default is 1.
     
     Returns
     -------
-    None.
+    raw : mne.io.Raw
+        The preprocessed raw data.
     """
-    # loading in the raw data
+    # reading the raw data without loading it, so only the channels and times that are used are loaded
     raw = mne.io.read_raw_fif(filepath, on_split_missing = 'ignore');
-    raw.load_data();
     raw.pick_types(meg=True, eeg=False, stim=True)
 
+    # crops out the noise associated with turning on continuous HPI 
+    raw.crop(tmin = tmin, tmax = tmax)
+    raw.load_data();
+
     # marking the channels as bad
     raw.info['bads'] = bad_channels
 
-    # crops out the noise associated with turning on continuous HPI 
-    cropped = raw.copy().crop(tmin = tmin, tmax = tmax)
-    del raw
+    ### BAND PASS FILTER ### (in place)
+    raw.filter(l_freq=1, h_freq=40, n_jobs=n_jobs)
+
+    ### RESAMPLING ### (in place)
+    raw.resample(250, n_jobs=n_jobs)
+
+    return raw
+
+def fit_ICA(raw, decim:int = None, reject_by_annotation:bool = True, warm_start_ica = None):
+    """
+    Fits FastICA to the raw data.
+
+    Parameters
+    ----------
+    raw : mne.io.Raw
+        The preprocessed raw data.
+    decim : int, optional
+        Only use every decim sample for fitting. The default is None (all samples).
+    reject_by_annotation : bool, optional
+        Whether to leave out segments annotated as bad. The default is True.
+    warm_start_ica : mne.preprocessing.ICA, optional
+        Earlier ICA solution of the same recording (e.g. before a small change of the session info). Its number of components is reused and FastICA is started from its unmixing matrix instead of a random one. The default is None.
+    
+    Returns
+    -------
+    ica : mne.preprocessing.ICA
+        The fitted ICA.
+    fit_time : float
+        Time it took to fit the ICA (in seconds).
+    """
+    n_components = 0.999
+    fit_params = None
 
-    ### BAND PASS FILTER ### 
-    filt_raw = cropped.copy().filter(l_freq=1, h_freq=40)
-    del cropped
+    if warm_start_ica is not None:
+        n_components = warm_start_ica.n_components_
 
-    ### RESAMPLING ###
-    resampled_raw = filt_raw.copy().resample(250)
-    del filt_raw
+        # MNE divides the FastICA unmixing matrix by the PCA whitening, undo it to get the matrix FastICA works with
+        whitening = np.sqrt(warm_start_ica.pca_explained_variance_[:n_components])
+        fit_params = {"w_init": warm_start_ica.unmixing_matrix_ * whitening[np.newaxis, :]}
+
+    ica = mne.preprocessing.ICA(n_components=n_components, random_state=97, method='fastica', max_iter=3000, fit_params=fit_params, verbose=True)
+
+    start = time.perf_counter()
+    ica.fit(raw, decim=decim, reject_by_annotation=reject_by_annotation)
+    fit_time = time.perf_counter() - start
+
+    return ica, fit_time
+
+def run_ICA_on_session(filepath:Path, outpath:Path, bad_channels:list, tmin:float, tmax:float, decim:int = None, warm_start:bool = False, n_jobs:int = 1):
+    """
+    Runs ICA on a single session and saves the ICA solution to a file.
+
+    Parameters
+    ----------
+    filepath : Path
+        Path to the raw fif file.
+    outpath : Path
+        Path to save the ICA solution to.
+    bad_channels : list
+        List of channels to mark as bad.
+    tmin : float
+        Start time of the recording (in seconds).
+    tmax : float
+        End time of the recording (in seconds).
+    decim : int, optional
+        Only use every decim sample for fitting the ICA. The default is None (all samples).
+    warm_start : bool, optional
+        Whether to start FastICA from the ICA solution already saved in outpath (if there is one). The default is False.
+    n_jobs : int, optional
+        Number of threads to use for filtering and resampling. The default is 1.
+    
+    Returns
+    -------
+    fit_info : dict
+        Dictionary with the time it took to fit the ICA (in seconds), the number of iterations and the number of components. Also saved to a .json file next to the ICA solution, together with the fingerprint of the inputs.
+    """
+    raw = prepare_raw_for_ICA(filepath, bad_channels, tmin, tmax, n_jobs)
+
+    warm_start_ica = None
+    if warm_start and outpath.exists():
+        warm_start_ica = mne.preprocessing.read_ica(outpath)
 
     ### ICA ###
-    ica = mne.preprocessing.ICA(n_components=0.999, random_state=97, method='fastica', max_iter=3000, verbose=True)
-    ica.fit(resampled_raw)
+    ica, fit_time = fit_ICA(raw, decim = decim, warm_start_ica = warm_start_ica)
 
     # saving the ICA solution
     ica.save(outpath, overwrite=True)
 
+    fit_info = {
+        "fingerprint": ica_fingerprint(filepath, bad_channels, tmin, tmax, decim),
+        "fit_time": fit_time,
+        "n_iter": int(ica.n_iter_),
+        "n_components": int(ica.n_components_),
+        "warm_start": warm_start_ica is not None
+    }
+
+    with open(outpath.with_suffix(".json"), 'w') as f:
+        json.dump(fit_info, f, indent=4)
+
+    return fit_info
+
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_cpu", type=int, default=multiprocessing.cpu_count(), help="Number of CPUs to use, default is all available")
+    parser.add_argument("--n_workers", "--n_jobs", type=int, default=1, help="Number of recordings to run ICA on in parallel, the CPUs are split between them (the BLAS threads of each worker are capped). Default is 1")
+    parser.add_argument("--decim", type=int, default=None, help="Only use every decim sample for fitting the ICA, default is all samples")
+    parser.add_argument("--warm_start", default=False, action="store_true", help="Start FastICA from the ICA solutions that are already saved for the recordings")
+    parser.add_argument("--force", default=False, action="store_true", help="Refit ICA for all recordings, also the ones that are up to date with the raw file and session info")
+    args = parser.parse_args()
+
+    n_workers = min(args.n_workers, args.num_cpu)
+    threads_per_job = max(1, args.num_cpu // n_workers)
+
     path = Path(__file__)
     outpath =  path.parents[1] / "ICA"
 
@@ -77,7 +229,7 @@ if __name__ == '__main__':
         file = f.read()
         session_info = json.loads(file)
 
-
+    jobs = []
     for subject in subjects: # loop over subjects
         subject_info = session_info[subject]
 
@@ -98,17 +250,25 @@ if __name__ == '__main__':
             # find the MEG recording file
             fif_file_path = list((subject_meg_path / "MEG" / recording_name / "files").glob("*.fif"))[0]
             
-            run_ICA_on_session(filepath = fif_file_path, 
-                               outpath = subject_outpath / f"{recording_name}-ica.fif", 
-                               bad_channels = subject_session_info["bad_channels"], 
-                               tmin = subject_session_info["tmin"], 
-                               tmax = subject_session_info["tmax"]
-                               )
+            job = {
+                "filepath": fif_file_path, 
+                "outpath": subject_outpath / f"{recording_name}-ica.fif", 
+                "bad_channels": subject_session_info["bad_channels"], 
+                "tmin": subject_session_info["tmin"], 
+                "tmax": subject_session_info["tmax"],
+                "decim": args.decim,
+                "warm_start": args.warm_start
+                }
 
-            
-
-    
+            # skip recordings where the ICA was fitted from the same raw file and session info
+            if not args.force and ica_is_up_to_date(job["outpath"], ica_fingerprint(fif_file_path, job["bad_channels"], job["tmin"], job["tmax"], job["decim"])):
+                print(f"ICA for {subject} {recording_name} is up to date, skipping")
+                continue
 
-    
+            jobs.append(job)
 
+    fit_infos = run_jobs_parallel(run_ICA_on_session, jobs, n_workers = n_workers, threads_per_job = threads_per_job)
 
+    # report the fit time and number of iterations per recording
+    for job, fit_info in zip(jobs, fit_infos):
+        print(f"{job['outpath'].parent.name} {job['outpath'].name}: {fit_info['fit_time']:.1f} s, {fit_info['n_iter']} iterations, {fit_info['n_components']} components")
@@ -0,0 +1,136 @@
+"""
+Early resampling validation script
+This script checks that resampling the continuous raw data before filtering, ICA and epoching (preprocess_data_sensorspace with resample_raw=True) gives the same epochs as resampling the epochs at the end (the default)
+
+Functions:
+    - match_epochs(epochs_a, epochs_b): Finds the epochs that are kept in both sets (created from the same event)
+    - compare_epochs(epochs_a, epochs_b): Calculates the difference between the matched epochs per channel type
+    - main(): defining paths, loading session info, preprocessing a recording in both ways and reporting the differences
+
+Notes:
+- The onsets of the events are rounded to the 250 Hz grid when the raw data is resampled, so the epochs can be shifted by up to half a sample (2 ms) which accounts for most of the difference
+- The script exits with an error if the correlation between the epochs is below the tolerance
+"""
+
+import argparse
+import json
+import sys
+import numpy as np
+from pathlib import Path
+
+# local imports
+sys.path.append(str(Path(__file__).parents[1]))
+from utils import preprocess_data_sensorspace
+
+
+def match_epochs(epochs_a, epochs_b):
+    """
+    Finds the epochs that are kept in both sets of epochs
+
+    Both sets are created from the same events (found at the original sampling frequency), so the epochs can be matched on the index of the event they were created from (epochs.selection)
+
+    Parameters
+    ----------
+    epochs_a : mne.Epochs
+        First set of epochs
+    epochs_b : mne.Epochs
+        Second set of epochs
+
+    Returns
+    -------
+    idx_a : np.array
+        Indices of the matched epochs in epochs_a
+    idx_b : np.array
+        Indices of the matched epochs in epochs_b
+    """
+    _, idx_a, idx_b = np.intersect1d(epochs_a.selection, epochs_b.selection, return_indices=True)
+
+    return idx_a, idx_b
+
+
+def compare_epochs(epochs_a, epochs_b):
+    """
+    Calculates the correlation and the relative root mean square difference between matched epochs for each channel type
+
+    Parameters
+    ----------
+    epochs_a : mne.Epochs
+        First set of epochs
+    epochs_b : mne.Epochs
+        Second set of epochs
+
+    Returns
+    -------
+    results : dict
+        Dictionary with the channel types as keys and dictionaries with the correlation and relative difference as values
+    n_matched : int
+        Number of matched epochs
+    """
+    idx_a, idx_b = match_epochs(epochs_a, epochs_b)
+
+    results = {}
+    for ch_type in ["mag", "grad"]:
+        data_a = epochs_a[idx_a].get_data(picks=ch_type)
+        data_b = epochs_b[idx_b].get_data(picks=ch_type)
+
+        # the epochs can differ by a sample in length, compare the common part
+        n_times = min(data_a.shape[-1], data_b.shape[-1])
+        data_a, data_b = data_a[..., :n_times].ravel(), data_b[..., :n_times].ravel()
+
+        results[ch_type] = {
+            "correlation": np.corrcoef(data_a, data_b)[0, 1],
+            "relative_rms_difference": np.sqrt(np.mean((data_a - data_b)**2)) / np.sqrt(np.mean(data_a**2))
+        }
+
+    return results, len(idx_a)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--subject", type=str, default="0108", help="Subject ID")
+    parser.add_argument("--recording", type=str, default="001.self_block1", help="Name of the recording")
+    parser.add_argument("--tolerance", type=float, default=0.99, help="Minimum correlation between the epochs")
+    args = parser.parse_args()
+
+    path = Path(__file__).parents[1]
+    MEG_DATA_PATH = Path("/work/834761")
+    ICA_PATH = path / "ICA"
+
+    with open(path / 'session_info.txt', 'r') as file:
+        SESSION_INFO = json.load(file)
+
+    subject_info = SESSION_INFO[args.subject]
+    subject_session_info = subject_info[args.recording]
+    subject_meg_path = list((MEG_DATA_PATH / args.subject).glob("*_000000"))[0]
+    fif_file_path = list((subject_meg_path / "MEG" / args.recording / "files").glob("*.fif"))[0]
+
+    if 'self' in args.recording:
+        event_id = {"img/self/positive": 11, "img/self/negative": 12, "button": 202}
+    elif 'other' in args.recording:
+        event_id = {"img/assigned/positive": 21, "img/assigned/negative": 22, "button": 202}
+
+    epochs = {}
+    for resample_raw in [False, True]:
+        epochs[resample_raw] = preprocess_data_sensorspace(
+            fif_file_path,
+            subject_session_info["bad_channels"],
+            subject_info["reject"],
+            ICA_PATH / args.subject / f"{args.recording}-ica.fif",
+            subject_session_info["noise_components"],
+            event_ids=event_id,
+            resample_raw=resample_raw
+        )
+
+    results, n_matched = compare_epochs(epochs[False], epochs[True])
+
+    print(f"Subject {args.subject}, recording {args.recording}")
+    print(f"Epochs: {len(epochs[False])} (resampling epochs), {len(epochs[True])} (resampling raw), {n_matched} matched")
+    for ch_type, result in results.items():
+        print(f"{ch_type}: correlation {result['correlation']:.4f}, relative RMS difference {result['relative_rms_difference']:.4f}")
+
+    if any(result["correlation"] < args.tolerance for result in results.values()):
+        sys.exit(f"The epochs differ more than the tolerance (correlation < {args.tolerance})")
+
+
+if __name__ == "__main__":
+    main()
@@ -10,7 +10,7 @@ Modules:
 Functions:
     - load_session_info(filepath): Reads session info from a given JSON file
     - get_event_id(recording_name): Determines the event ID based on the recording name
-    - process_subject_data(subject, recording_name, session_info, MEG_data_path, ICA_path, plot_path): 
+    - process_subject_data(subject, recording_name, session_info, MEG_data_path, ICA_path, plot_path, cache_dir): 
       Processes the MEG data for a given subject and recording name and generates ERF plots
     - calculate_and_plot_erf(epochs, event_id=None, title=None, filename=None): 
     - main(): defining paths, loading session info, and iterating over subjects and recordings to process the data
@@ -111,7 +111,7 @@ def get_event_id(recording_name):
         }
 
 # processing_subject_data
-def process_subject_data(subject, recording_name, session_info, MEG_data_path, ICA_path, plot_path):
+def process_subject_data(subject, recording_name, session_info, MEG_data_path, ICA_path, plot_path, cache_dir=None):
     subject_info = session_info[subject]
     reject = subject_info["reject"]
     subject_path = MEG_data_path / subject
@@ -127,7 +127,8 @@ def process_subject_data(subject, recording_name, session_info, MEG_data_path, I
         reject,
         ICA_path_sub,
         subject_info[recording_name]["noise_components"],
-        event_ids=event_id
+        event_ids=event_id,
+        cache_dir=cache_dir
     )
 
     print(f"### \n ### EPOCH EVENT_ID after drop are: {epochs.event_id} ### \n ###")
@@ -147,6 +148,7 @@ def main():
     MEG_DATA_PATH = Path("/work/834761")
     ICA_PATH = Path("/work/study_group_8/ICA")
     PLOT_PATH = NOTEBOOK_PATH / "plots_button_removed_topo"
+    EPOCHS_CACHE_PATH = NOTEBOOK_PATH / "epochs_cache"
 
     PLOT_PATH.mkdir(parents=True, exist_ok=True)
 
@@ -160,7 +162,7 @@ def main():
 
     for subject in SUBJECTS:
         for recording_name in RECORDING_NAMES:
-            process_subject_data(subject, recording_name, SESSION_INFO, MEG_DATA_PATH, ICA_PATH, PLOT_PATH)
+            process_subject_data(subject, recording_name, SESSION_INFO, MEG_DATA_PATH, ICA_PATH, PLOT_PATH, EPOCHS_CACHE_PATH)
 
 
 if __name__ == '__main__':
@@ -97,6 +97,7 @@ def main():
     MEG_DATA_PATH = Path("/work/834761")
     ICA_PATH = Path("/work/study_group_8/ICA")
     PLOT_PATH = NOTEBOOK_PATH / "plots_button_removed_topo"
+    EPOCHS_CACHE_PATH = NOTEBOOK_PATH / "epochs_cache"
     PLOT_PATH.mkdir(parents=True, exist_ok=True)
 
     with open(NOTEBOOK_PATH / 'session_info.txt', 'r') as file:
@@ -130,7 +131,8 @@ def main():
                 reject,
                 ICA_path_sub,
                 subject_session_info["noise_components"],
-                event_ids=event_id
+                event_ids=event_id,
+                cache_dir=EPOCHS_CACHE_PATH
             )
 
             print(f"### \n ### EPOCH EVENT_ID after drop are: {epochs.event_id} ### \n ###")
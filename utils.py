@@ -1,9 +1,140 @@
 
+import os
+import json
+import hashlib
+import functools
 import mne
 import numpy as np
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
-def preprocess_data_sensorspace(fif_path:Path, bad_channels:list = [], reject = None, ica_path:Path = None, noise_components = None, event_ids = None, tmin = -0.2, tmax = 1, n_jobs = 4):
+THREAD_ENV_VARS = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "NUMEXPR_NUM_THREADS"]
+
+# make_label_operator uses private functions of mne.minimum_norm, checked against this version (see requirements.txt)
+LABEL_OPERATOR_MNE_VERSION = "1.5"
+
+@functools.lru_cache(maxsize = 2)
+def read_pooled_file(reader, path:str, mtime_ns:int):
+    """
+    Reads a file with reader. Cached on the reader, path and modification time, see read_pooled.
+    """
+    return reader(path)
+
+def read_pooled(reader, path:Path):
+    """
+    Reads a heavy MNE object that is used several times per process (e.g. the source morph of a subject, which all recordings of the subject share) once and shares it between all callers.
+
+    The objects are kept in a LRU pool of two keyed on the reader, the absolute path and the modification time of the file, so a file that changes on disk is read again. Only files that are read repeatedly should be pooled, objects that are used once (e.g. the forward solution of a recording) would only be kept in memory for longer. The returned object is shared, so it must not be modified in place.
+
+    Parameters
+    ----------
+    reader : callable
+        Function reading the file, e.g. mne.read_source_morph or mne.read_source_spaces.
+    path : Path
+        Path to the file.
+    
+    Returns
+    -------
+    obj
+        The object returned by reader.
+    """
+    path = Path(path).resolve()
+
+    return read_pooled_file(reader, str(path), path.stat().st_mtime_ns)
+
+def save_atomic(path:Path, write, *args, **kwargs):
+    """
+    Writes a file by calling write(tmp_path, *args, **kwargs) on a temporary file next to path and then moving it into place, so other processes never read a half written file.
+
+    The temporary file name ends with the name of path, so writers that check the file ending (e.g. -epo.fif, -inv.fif, .npy) accept it.
+
+    Parameters
+    ----------
+    path : Path
+        Path to write to.
+    write : callable
+        Function writing the file, e.g. np.save, epochs.save or mne.minimum_norm.write_inverse_operator.
+    *args, **kwargs
+        Further arguments passed on to write.
+    
+    Returns
+    -------
+    path : Path
+        Path the file was written to.
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f".tmp-{os.getpid()}-{path.name}")
+
+    try:
+        write(tmp_path, *args, **kwargs)
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok = True)
+
+    return path
+
+def save_concatenated(path:Path, parts:list, axis:int = 0):
+    """
+    Concatenates arrays along an axis directly into a .npy file, without holding the concatenated array in memory.
+
+    Parameters
+    ----------
+    path : Path
+        Path to the .npy file.
+    parts : list
+        List of (memory mapped) arrays with the same shape except along axis.
+    axis : int, optional
+        Axis to concatenate along. The default is 0.
+    
+    Returns
+    -------
+    shape : tuple
+        Shape of the concatenated array.
+    """
+    shape = list(parts[0].shape)
+    shape[axis] = sum(part.shape[axis] for part in parts)
+
+    def write(tmp_path):
+        out = np.lib.format.open_memmap(tmp_path, mode = "w+", dtype = parts[0].dtype, shape = tuple(shape))
+
+        index = [slice(None)] * out.ndim
+        start = 0
+        for part in parts:
+            index[axis] = slice(start, start + part.shape[axis])
+            out[tuple(index)] = part
+            start += part.shape[axis]
+
+        out.flush()
+        del out
+
+    save_atomic(path, write)
+
+    return tuple(shape)
+
+def digest(obj, *arrays):
+    """
+    Hex digest identifying a JSON serialisable object (e.g. a dictionary with file fingerprints and arguments) and the contents of arrays.
+
+    Parameters
+    ----------
+    obj : object
+        Object to identify. Objects that cannot be serialised are converted with str.
+    *arrays : np.array
+        Arrays whose contents are included.
+    
+    Returns
+    -------
+    digest : str
+        Hex digest.
+    """
+    sha1 = hashlib.sha1(json.dumps(obj, sort_keys = True, default = str).encode())
+    for array in arrays:
+        sha1.update(np.ascontiguousarray(array).tobytes())
+
+    return sha1.hexdigest()
+
+def preprocess_data_sensorspace(fif_path:Path, bad_channels:list = [], reject = None, ica_path:Path = None, noise_components = None, event_ids = None, tmin = -0.2, tmax = 1, resample_sfreq = 250, resample_raw = False, preload = True, n_jobs = 4, cache_dir:Path = None, cache_max_gb:float = 20):
     """
     
     Parameters
@@ -20,14 +151,51 @@ def preprocess_data_sensorspace(fif_path:Path, bad_channels:list = [], reject =
         List of noise ICA components. The default is None.
     event_ids: dict, optional
         Dictionary with event ids and triggers to include in the epochs. Default is None
+    tmin : float, optional
+        Start time of the epochs (in seconds). The default is -0.2.
+    tmax : float, optional
+        End time of the epochs (in seconds). The default is 1.
+    resample_sfreq : float, optional
+        Sampling frequency to resample the epochs to. The default is 250.
+    resample_raw : bool, optional
+        Whether to resample the continuous raw data (with the events rescaled accordingly) before filtering, applying ICA and epoching, instead of resampling the epochs at the end. The filtering and ICA then work on fewer samples. The default is False.
+    preload : bool, optional
+        Whether to load the epochs into memory. If False, the epochs are read from the filtered raw data when they are used, and they are decimated instead of resampled (the raw sampling frequency has to be a multiple of resample_sfreq, the 40 Hz low pass acts as anti-aliasing filter). The default is True.
+    n_jobs : int, optional
+        Number of jobs to use for filtering and resampling. The default is 4.
+    cache_dir : Path, optional
+        Directory to cache the epochs in. If the epochs have already been computed with the same input file and arguments they are read from the cache instead. The default is None (no caching).
+    cache_max_gb : float, optional
+        Maximum size of the cache in GB. The least recently used epochs are removed when the cache grows larger. The default is 20.
     
     Returns
     -------
     epochs : mne.Epochs
         Epochs object.
     """
+    if cache_dir is not None:
+        cache_dir = Path(cache_dir)
+        cache_dir.mkdir(parents=True, exist_ok=True)
+
+        key = epochs_cache_key(fif_path, bad_channels = bad_channels, reject = reject, ica_path = ica_path, noise_components = noise_components, event_ids = event_ids, tmin = tmin, tmax = tmax, resample_sfreq = resample_sfreq, resample_raw = resample_raw, preload = preload, fmt = "double")
+        cache_path = cache_dir / f"{key}-epo.fif"
+
+        # another worker can evict the file at any time, a file that disappears is treated as a cache miss
+        try:
+            # mark as recently used
+            os.utime(cache_path)
+            return mne.read_epochs(cache_path, preload = preload)
+        except FileNotFoundError:
+            pass
+
     raw = mne.io.read_raw_fif(fif_path, preload = True)
 
+    if resample_raw:
+        # find the events at the original sampling frequency (filtering and ICA do not change the stim channel)
+        events = mne.find_events(raw, min_duration=2/raw.info["sfreq"])
+
+        # downsampling (includes anti-alias low pass filtering), the events are moved to the new sampling frequency
+        raw, events = raw.resample(resample_sfreq, events = events, n_jobs = n_jobs)
 
     # Low pass filtering to get rid of line noise
     raw.filter(0.1, 40, n_jobs = n_jobs)
@@ -41,22 +209,215 @@ def preprocess_data_sensorspace(fif_path:Path, bad_channels:list = [], reject =
         # apply ica
         ica.apply(raw)
 
-    # find the events
-    events = mne.find_events(raw, min_duration=2/raw.info["sfreq"])
+    if not resample_raw:
+        # find the events
+        events = mne.find_events(raw, min_duration=2/raw.info["sfreq"])
 
     # remove bad channels
     raw.drop_channels(bad_channels)
 
-    # epoching
-    epochs = mne.Epochs(raw, events, event_id = event_ids, tmin=tmin, tmax=tmax, baseline=(None, 0), preload = True, reject = reject, proj = True)
+    if preload:
+        # epoching
+        epochs = mne.Epochs(raw, events, event_id = event_ids, tmin=tmin, tmax=tmax, baseline=(None, 0), preload = True, reject = reject, proj = True)
+
+        # downsampling
+        if not resample_raw:
+            epochs.resample(resample_sfreq, n_jobs = n_jobs)
+    else:
+        decim = raw.info["sfreq"] / resample_sfreq
+        if decim != int(decim):
+            raise ValueError(f"The sampling frequency {raw.info['sfreq']} is not a multiple of {resample_sfreq}, use preload = True to resample")
+
+        # epoching and downsampling, the data is only read from raw when the epochs are used
+        epochs = mne.Epochs(raw, events, event_id = event_ids, tmin=tmin, tmax=tmax, baseline=(None, 0), preload = False, reject = reject, proj = True, decim = int(decim))
+
+        # apply the rejection now, so the events match the epochs that are used later
+        epochs.drop_bad()
 
-    # downsampling
-    epochs.resample(250, n_jobs = n_jobs)
+    if cache_dir is not None:
+        # saved in double precision (MNE saves single by default), so a cache hit gives the same data as the miss that wrote it
+        save_atomic(cache_path, epochs.save, overwrite = True, fmt = "double")
+
+        evict_epochs_cache(cache_dir, max_bytes = int(cache_max_gb * 1e9))
     
     return epochs
 
+def file_fingerprint(path:Path):
+    """
+    Identifies a file by its absolute path, size and modification time.
+
+    Parameters
+    ----------
+    path : Path
+        Path to the file. If None, None is returned.
+    
+    Returns
+    -------
+    fingerprint : list
+        List with the absolute path, size and modification time (in ns) of the file.
+    """
+    if path is None:
+        return None
+
+    path = Path(path).resolve()
+    stat = path.stat()
+
+    return [str(path), stat.st_size, stat.st_mtime_ns]
+
+def epochs_cache_key(fif_path:Path, ica_path:Path = None, **kwargs):
+    """
+    Creates a key for the epochs cache from the identity of the input files and the preprocessing arguments.
+
+    Parameters
+    ----------
+    fif_path : Path
+        Path to the fif file.
+    ica_path : Path, optional
+        Path to the ICA file. The default is None.
+    **kwargs
+        Remaining arguments to preprocess_data_sensorspace that change the resulting epochs.
+    
+    Returns
+    -------
+    key : str
+        Hex digest identifying the epochs.
+    """
+    key = {
+        "fif": file_fingerprint(fif_path),
+        "ica": file_fingerprint(ica_path),
+        **kwargs
+    }
+
+    return digest(key)
+
+def evict_epochs_cache(cache_dir:Path, max_bytes:int):
+    """
+    Removes the least recently used epochs from the cache until the cache is smaller than max_bytes.
+
+    Parameters
+    ----------
+    cache_dir : Path
+        Directory with the cached epochs.
+    max_bytes : int
+        Maximum size of the cache in bytes.
+    
+    Returns
+    -------
+    None.
+    """
+    # other workers can remove files while the cache is listed, those are skipped
+    files = []
+    for f in Path(cache_dir).glob("*-epo.fif"):
+        if ".tmp" in f.name:
+            continue
+        try:
+            stat = f.stat()
+        except FileNotFoundError:
+            continue
+        files.append((stat.st_mtime_ns, stat.st_size, f))
+    files.sort()
+
+    total = sum(size for _, size, _ in files)
+
+    # never remove the most recently used file
+    for _, size, f in files[:-1]:
+        if total <= max_bytes:
+            break
+        f.unlink(missing_ok = True)
+        total -= size
+
+
+def compute_baseline_covariance(epochs, tmin = None, tmax = 0.0):
+    """
+    Computes the empirical noise covariance from the baseline of the epochs, reading one epoch at a time.
+
+    The cross-products are summed one epoch at a time, so the epochs do not have to be preloaded and only a (n_channels, n_channels) array is kept in memory. Like the default empirical method of mne.compute_covariance(epochs, tmin=tmin, tmax=tmax) (MNE 1.5), the data is not re-centred, the sum is divided by the number of samples and nfree is the number of samples minus one.
+
+    Parameters
+    ----------
+    epochs : mne.Epochs
+        Epochs object, does not have to be preloaded.
+    tmin : float, optional
+        Start of the baseline (in seconds). The default is None (start of the epochs).
+    tmax : float, optional
+        End of the baseline (in seconds). The default is 0.0.
+    
+    Returns
+    -------
+    noise_cov : mne.Covariance
+        Noise covariance.
+    """
+    picks = mne.pick_types(epochs.info, meg = True, eeg = True, ref_meg = False, exclude = "bads")
+    
+    times = epochs.times
+    tmask = np.ones(len(times), dtype = bool)
+    if tmin is not None:
+        tmask &= times >= tmin
+    if tmax is not None:
+        tmask &= times <= tmax
+
+    n = 0
+    cross_products = np.zeros((len(picks), len(picks)))
+
+    for epoch in epochs:
+        data = epoch[picks][:, tmask]
+        cross_products += data @ data.T
+        n += data.shape[1]
+
+    if n < 2:
+        raise ValueError("Not enough baseline samples to compute the noise covariance")
+
+    ch_names = [epochs.ch_names[pick] for pick in picks]
+
+    return mne.Covariance(cross_products / n, ch_names, epochs.info["bads"], epochs.info["projs"], nfree = n - 1)
+
+def make_inverse_operator_cached(info, fwd, noise_cov, fwd_path:Path = None):
+    """
+    Makes an inverse operator, or reads it from disk if it has already been computed from the same inputs.
+
+    The inverse operators are stored as -inv.fif files next to the forward solution, with a key in the filename computed from the forward solution file, the channels and projections in info and the noise covariance.
+
+    Parameters
+    ----------
+    info : mne.Info
+        Measurement info (after dropping bad channels).
+    fwd : mne.Forward
+        Forward solution.
+    noise_cov : mne.Covariance
+        Noise covariance.
+    fwd_path : Path, optional
+        Path the forward solution was read from. If None, the inverse operator is not cached. The default is None.
+    
+    Returns
+    -------
+    inv : mne.minimum_norm.InverseOperator
+        Inverse operator.
+    """
+    if fwd_path is None:
+        return mne.minimum_norm.make_inverse_operator(info, fwd, noise_cov)
+
+    fwd_path = Path(fwd_path)
+    key = {
+        "fwd": file_fingerprint(fwd_path),
+        "ch_names": info["ch_names"],
+        "bads": info["bads"],
+        "projs": [(proj["desc"], proj["active"]) for proj in info["projs"]],
+        "cov_names": noise_cov.ch_names,
+        "cov_nfree": noise_cov["nfree"]
+    }
+    key = digest(key, noise_cov.data)
+
+    inv_path = fwd_path.with_name(f"{fwd_path.name.removesuffix('-fwd.fif')}-{key[:16]}-inv.fif")
+
+    if inv_path.exists():
+        return mne.minimum_norm.read_inverse_operator(inv_path)
+
+    inv = mne.minimum_norm.make_inverse_operator(info, fwd, noise_cov)
+    save_atomic(inv_path, mne.minimum_norm.write_inverse_operator, inv, overwrite = True)
+
+    return inv
 
-def epochs_to_sourcespace(epochs, fwd,  pick_ori='normal', lambda2=1.0 / 9.0, method='dSPM', label=None, n_jobs = 4):
+def epochs_to_sourcespace(epochs, fwd,  pick_ori='normal', lambda2=1.0 / 9.0, method='dSPM', label=None, fwd_path:Path = None):
     """
     Parameters
     ----------
@@ -72,15 +433,17 @@ def epochs_to_sourcespace(epochs, fwd,  pick_ori='normal', lambda2=1.0 / 9.0, me
         Inverse method. The default is 'dSPM'.
     label : mne.Label, optional
         Label to restrict the inverse solution to. The default is None.
+    fwd_path : Path, optional
+        Path the forward solution was read from. If given, the inverse operator is cached next to it, see make_inverse_operator_cached. The default is None.
     
     Returns
     -------
     stcs : list
         List of source time courses.
     """
-    noise_cov = mne.compute_covariance(epochs, tmax=0.000, n_jobs=n_jobs)
+    noise_cov = compute_baseline_covariance(epochs, tmax=0.000)
     
-    inv = mne.minimum_norm.make_inverse_operator(epochs.info, fwd, noise_cov)
+    inv = make_inverse_operator_cached(epochs.info, fwd, noise_cov, fwd_path)
 
     stcs = mne.minimum_norm.apply_inverse_epochs(epochs, inv, lambda2, method, label, pick_ori=pick_ori)
     
@@ -104,22 +467,251 @@ def morph_stcs_label(morph_path:Path, stcs:list, fs_subjects_dir:Path, label_reg
     X : np.array
         Array with source time courses.
     """
-    morph = mne.read_source_morph(morph_path)
-            
-    # morph from subject to fsaverage
-    stcs = [morph.apply(stc) for stc in stcs]
+    return morph_stcs_labels(morph_path, stcs, fs_subjects_dir, [label_regexp])[label_regexp]
+
+def morph_stcs_labels(morph_path:Path, stcs:list, fs_subjects_dir:Path, label_regexps:list, label_cache_file:Path = None):
+    """
+    Morphs the source time courses to fsaverage once and extracts the data for several labels.
+
+    Parameters
+    ----------
+    morph_path : Path
+        Path to the morph file.
+    stcs : list
+        List of source time courses to morph.
+    fs_subjects_dir : Path
+        Path to the freesurfer subjects directory.
+    label_regexps : list
+        List of regular expressions, each selecting the label(s) to extract.
+    label_cache_file : Path, optional
+        Path to a .npz file to persist the label vertices in, see get_label_vertices. The default is None.
+    
+    Returns
+    -------
+    Xs : dict
+        Dictionary with the label regular expressions as keys and arrays with source time courses as values.
+    """
+    morph = read_pooled(mne.read_source_morph, morph_path)
 
-    labels = mne.read_labels_from_annot("fsaverage", parc="aparc", subjects_dir=fs_subjects_dir, regexp=label_regexp)
-    vertices = np.concatenate([label.get_vertices_used(stcs[0].vertices[0]) for label in labels])
+    if any(not np.array_equal(v1, v2) for v1, v2 in zip(stcs[0].vertices, morph.src_data["vertices_from"])):
+        raise ValueError("The vertices of the source time courses do not match the vertices the morph was computed from")
+
+    label_vertices = [get_label_vertices(fs_subjects_dir, label_regexp, morph.vertices_to, cache_file=label_cache_file) for label_regexp in label_regexps]
+
+    # stack all epochs into one (n_sources, n_epochs * n_times) block
+    n_epochs, n_times = len(stcs), stcs[0].data.shape[1]
+    data = np.concatenate([stc.data for stc in stcs], axis=1)
             
-    X = np.array([stc.data[vertices, :] for stc in stcs])
+    # morph from subject to fsaverage, only the rows of the morph matrix for the label vertices are needed
+    X = morph.morph_mat[np.concatenate(label_vertices)] @ data
+    X = np.asarray(X).reshape(-1, n_epochs, n_times).transpose(1, 0, 2)
+
+    return split_labels(X, label_regexps, label_vertices)
+
+# process-wide cache of label vertices, see get_label_vertices
+LABEL_VERTICES_CACHE = {}
+
+def get_label_vertices(fs_subjects_dir:Path, label_regexp:str, vertices:list, parc:str = "aparc", cache_file:Path = None):
+    """
+    Finds the fsaverage sources in the label(s) selected by a regular expression.
+
+    Labels on the right hemisphere are looked up in the right hemisphere vertices and offset by the number of left hemisphere sources, so the result indexes the rows of the morph matrix (left hemisphere sources followed by right hemisphere sources).
+
+    The result is cached for the lifetime of the process, so the annotation is only read from disk once per subjects directory, parcellation, regular expression and source space. If cache_file is given, the results are also stored in a .npz file so other processes can reuse them.
+
+    Parameters
+    ----------
+    fs_subjects_dir : Path
+        Path to the freesurfer subjects directory.
+    label_regexp : str
+        Regular expression to select the label(s) from the parcellation.
+    vertices : list
+        Vertices of the fsaverage source space that the data is defined on, one array per hemisphere (e.g. morph.vertices_to).
+    parc : str, optional
+        Parcellation to read the labels from. The default is "aparc".
+    cache_file : Path, optional
+        Path to a .npz file to persist the label vertices in. The default is None.
+    
+    Returns
+    -------
+    label_vertices : np.array
+        Array with the indices of the sources in the label(s).
+    """
+    key = digest([str(Path(fs_subjects_dir).resolve()), parc, label_regexp, [len(v) for v in vertices]], *vertices)
+
+    if key in LABEL_VERTICES_CACHE:
+        return LABEL_VERTICES_CACHE[key]
+
+    if cache_file is not None and Path(cache_file).exists():
+        with np.load(cache_file) as stored:
+            LABEL_VERTICES_CACHE.update({k: stored[k] for k in stored.files})
+
+        if key in LABEL_VERTICES_CACHE:
+            return LABEL_VERTICES_CACHE[key]
+
+    labels = mne.read_labels_from_annot("fsaverage", parc=parc, subjects_dir=fs_subjects_dir, regexp=label_regexp)
+    
+    rows = []
+    for label in labels:
+        hemi = 0 if label.hemi == "lh" else 1
+        offset = 0 if hemi == 0 else len(vertices[0])
+        rows.append(np.searchsorted(vertices[hemi], label.get_vertices_used(vertices[hemi])) + offset)
+
+    LABEL_VERTICES_CACHE[key] = np.concatenate(rows)
+
+    if cache_file is not None:
+        save_atomic(cache_file, np.savez, **LABEL_VERTICES_CACHE)
+
+    return LABEL_VERTICES_CACHE[key]
+
+def split_labels(X:np.array, label_regexps:list, label_vertices:list):
+    """
+    Splits data for the concatenated vertices of several labels into one array per label.
+
+    Parameters
+    ----------
+    X : np.array
+        Array with shape (n_epochs, n_vertices, n_times), with the vertices of the labels concatenated in order.
+    label_regexps : list
+        List of regular expressions for the labels.
+    label_vertices : list
+        List with the vertices of each label.
+    
+    Returns
+    -------
+    Xs : dict
+        Dictionary with the label regular expressions as keys and arrays with shape (n_epochs, n_label_vertices, n_times) as values.
+    """
+    Xs = {}
+    start = 0
+    for label_regexp, vertices in zip(label_regexps, label_vertices):
+        Xs[label_regexp] = np.ascontiguousarray(X[:, start:start + len(vertices), :])
+        start += len(vertices)
 
-    return X
+    return Xs
 
-def flip_sign(X1, X2):
+def make_label_operator(epochs, fwd, morph, vertices:np.array, pick_ori='normal', lambda2=1.0 / 9.0, method='dSPM', fwd_path:Path = None):
+    """
+    Combines the inverse operator and the morph to fsaverage into a single linear operator that maps the sensor data directly to the selected fsaverage vertices.
+
+    The kernel is assembled with private functions of mne.minimum_norm, so a RuntimeError is raised for MNE versions other than LABEL_OPERATOR_MNE_VERSION.
+
+    Parameters
+    ----------
+    epochs : mne.Epochs
+        Epochs object. Used to compute the noise covariance.
+    fwd : mne.Forward
+        Forward solution.
+    morph : mne.SourceMorph
+        Morph from the subject to fsaverage.
+    vertices : np.array
+        Indices of the morphed fsaverage sources to keep.
+    pick_ori : str, optional
+        Orientation of the inverse solution. The default is 'normal'.
+    lambda2 : float, optional
+        Regularization parameter. The default is 1.0 / 9.0.
+    method : str, optional
+        Inverse method. The default is 'dSPM'.
+    fwd_path : Path, optional
+        Path the forward solution was read from. If given, the inverse operator is cached next to it, see make_inverse_operator_cached. The default is None.
+    
+    Returns
+    -------
+    operator : np.array
+        Array with shape (n_vertices, n_channels).
+    sel : np.array
+        Indices of the epochs channels the operator is applied to.
+    """
+    if ".".join(mne.__version__.split(".")[:2]) != LABEL_OPERATOR_MNE_VERSION:
+        raise RuntimeError(f"make_label_operator relies on private MNE functions checked against MNE {LABEL_OPERATOR_MNE_VERSION}, found {mne.__version__}. Install the version in requirements.txt or use full source estimates instead")
+
+    from mne.minimum_norm.inverse import _assemble_kernel, _pick_channels_inverse_operator
+
+    if pick_ori != 'normal':
+        raise ValueError("Only pick_ori='normal' gives a linear operator that can be combined with the morph")
+
+    noise_cov = compute_baseline_covariance(epochs, tmax=0.000)
+    
+    inv = make_inverse_operator_cached(epochs.info, fwd, noise_cov, fwd_path)
+
+    # same preparation as apply_inverse_epochs (nave = 1 for single epochs)
+    inv = mne.minimum_norm.prepare_inverse_operator(inv, 1, lambda2, method)
+    sel = _pick_channels_inverse_operator(epochs.ch_names, inv)
+    K, noise_norm, vertno, _ = _assemble_kernel(inv, None, method, pick_ori)
+
+    if noise_norm is not None:
+        K *= noise_norm
+
+    vertices_from = morph.src_data["vertices_from"]
+    if any(not np.array_equal(v1, v2) for v1, v2 in zip(vertno, vertices_from)):
+        raise ValueError("The vertices of the forward solution do not match the vertices the morph was computed from")
+
+    # only the rows of the morph matrix for the selected vertices are needed
+    operator = morph.morph_mat[vertices] @ K
+
+    return np.asarray(operator), sel
+
+def epochs_to_labels(epochs, fwd, morph_path:Path, fs_subjects_dir:Path, label_regexps:list, pick_ori='normal', lambda2=1.0 / 9.0, method='dSPM', label_cache_file:Path = None, fwd_path:Path = None):
+    """
+    Projects the epochs to the fsaverage vertices of several labels without computing whole-cortex source estimates.
+
+    Gives the same result as epochs_to_sourcespace followed by morph_stcs_labels, but the inverse solution and the morph are applied as one (n_vertices, n_channels) operator in a single matrix product, so memory scales with the size of the labels rather than the cortex.
+
+    Parameters
+    ----------
+    epochs : mne.Epochs
+        Epochs object.
+    fwd : mne.Forward
+        Forward solution.
+    morph_path : Path
+        Path to the morph file.
+    fs_subjects_dir : Path
+        Path to the freesurfer subjects directory.
+    label_regexps : list
+        List of regular expressions, each selecting the label(s) to extract.
+    pick_ori : str, optional
+        Orientation of the inverse solution. The default is 'normal'.
+    lambda2 : float, optional
+        Regularization parameter. The default is 1.0 / 9.0.
+    method : str, optional
+        Inverse method. The default is 'dSPM'.
+    label_cache_file : Path, optional
+        Path to a .npz file to persist the label vertices in, see get_label_vertices. The default is None.
+    fwd_path : Path, optional
+        Path the forward solution was read from. If given, the inverse operator is cached next to it, see make_inverse_operator_cached. The default is None.
+    
+    Returns
+    -------
+    Xs : dict
+        Dictionary with the label regular expressions as keys and arrays with shape (n_epochs, n_vertices, n_times) as values.
+    """
+    morph = read_pooled(mne.read_source_morph, morph_path)
+
+    label_vertices = [get_label_vertices(fs_subjects_dir, label_regexp, morph.vertices_to, cache_file=label_cache_file) for label_regexp in label_regexps]
+
+    operator, sel = make_label_operator(epochs, fwd, morph, np.concatenate(label_vertices), pick_ori, lambda2, method, fwd_path)
+
+    if epochs.preload:
+        data = epochs.get_data()[:, sel, :]
+        n_epochs, n_channels, n_times = data.shape
+
+        # (n_channels, n_epochs * n_times) so all epochs are projected in one matrix product
+        data = data.transpose(1, 0, 2).reshape(n_channels, n_epochs * n_times)
+        X = (operator @ data).reshape(-1, n_epochs, n_times).transpose(1, 0, 2)
+    else:
+        # read and project one epoch at a time
+        X = np.empty((len(epochs), operator.shape[0], len(epochs.times)))
+        for i, epoch in enumerate(epochs):
+            X[i] = operator @ epoch[sel]
+
+    return split_labels(X, label_regexps, label_vertices)
+
+def flip_sign(X1, X2, signs = None, return_signs = False):
     """
     This function is used to flip the sign of the data in X2 if the correlation between the data in X1 and X2 is negative.
 
+    The correlations for all parcels are computed at once, and X2 is flipped in place.
+
     Parameters
     ----------
     X1 (array): 
@@ -128,34 +720,51 @@ def flip_sign(X1, X2):
     X2 (array): 
         Data from the session to flip the sign of with shape (n_trials, n_channels, n_times)
 
+    signs (array, optional):
+        Signs (1 or -1) to multiply the parcels of X2 with, e.g. as returned by an earlier call. If given, X1 is not used to compute them. Default is None.
+
+    return_signs (bool, optional):
+        Whether to also return the signs, so they can be reused. Default is False.
+
     Returns
     -------
     X2 (ndarray): 
         X2 with the sign flipped if the correlation between X1 and X2 is negative in the given parcel with shape (n_channels, n_trials, n_times)
+
+    signs (ndarray):
+        Only returned if return_signs is True. Array with shape (n_channels, ) with -1 for the flipped parcels and 1 otherwise.
     """
 
-    # checking that the T and P dimensions are the same
-    if X1.shape[2] != X2.shape[2]:
-        raise ValueError('The number of time points in the two sessions are not the same')
-    
-    if X1.shape[1] != X2.shape[1]:
-        raise ValueError('The number of parcels in the two sessions are not the same')
+    if signs is None:
+        # checking that the T and P dimensions are the same
+        if X1.shape[2] != X2.shape[2]:
+            raise ValueError('The number of time points in the two sessions are not the same')
+        
+        if X1.shape[1] != X2.shape[1]:
+            raise ValueError('The number of parcels in the two sessions are not the same')
+
+        # take means over trials, shape (n_channels, n_times)
+        mean1 = np.mean(X1, axis = 0)
+        mean2 = np.mean(X2, axis = 0)
+
+        # pearson correlation between the means for every parcel
+        mean1 = mean1 - np.mean(mean1, axis = 1, keepdims = True)
+        mean2 = mean2 - np.mean(mean2, axis = 1, keepdims = True)
 
-    # loop over parcels
-    for i in range(X1.shape[1]):
-        # take means over trials
-        mean1 = np.mean(X1[:, i, :], axis = 0)
-        mean2 = np.mean(X2[:, i, :], axis = 0)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            corr = np.sum(mean1 * mean2, axis = 1) / np.sqrt(np.sum(mean1**2, axis = 1) * np.sum(mean2**2, axis = 1))
 
-        # calculate correlation
-        corr = np.corrcoef(mean1, mean2)[0, 1]
+        # if correlation is negative, flip sign (parcels without a defined correlation are left as they are)
+        signs = np.where(corr < 0, -1, 1)
 
-        if corr < 0: # if correlation is negative, flip sign
-            X2[:, i, :] = X2[:, i, :] * -1
+    X2 *= np.asarray(signs)[np.newaxis, :, np.newaxis]
+
+    if return_signs:
+        return X2, signs
 
     return X2
 
-def n_trials(X, y, n: int, axis: int=0):
+def n_trials(X, y, n: int, axis: int=0, rng = None):
     """
     Removes trials from X and y, such that the number of trials is equal to n. It is assumed that classes are already balanced. Therefore an equal number of trials is removed from each class.
 
@@ -169,6 +778,8 @@ def n_trials(X, y, n: int, axis: int=0):
         number of trials to keep
     axis : int, optional
         axis along which to remove trials from X array, by default 0
+    rng : np.random.Generator, optional
+        random number generator used to choose the trials, by default None (the global numpy random state)
     
     Returns:
     -------
@@ -185,8 +796,9 @@ def n_trials(X, y, n: int, axis: int=0):
     n_remove = (n_trials - n)//2
 
     # getting indices of trials to remove
-    idx_0 = np.random.choice(np.where(y==0)[0], n_remove, replace=False)
-    idx_1 = np.random.choice(np.where(y==1)[0], n_remove, replace=False)
+    rng = np.random if rng is None else rng
+    idx_0 = rng.choice(np.where(y==0)[0], n_remove, replace=False)
+    idx_1 = rng.choice(np.where(y==1)[0], n_remove, replace=False)
 
     # combining indices
     idx = np.concatenate((idx_0, idx_1))
@@ -197,7 +809,7 @@ def n_trials(X, y, n: int, axis: int=0):
 
     return X, y
 
-def equalise_trials(Xs:list, ys:list):
+def equalise_trials(Xs:list, ys:list, rng = None):
     """
     This function is used to equalise the number of trials across a list of X and y arrays.
 
@@ -207,6 +819,8 @@ def equalise_trials(Xs:list, ys:list):
         list of X arrays
     ys : list
         list of y arrays
+    rng : np.random.Generator, optional
+        random number generator used to choose the trials to remove, by default None (the global numpy random state)
     
     Returns
     -------
@@ -220,6 +834,49 @@ def equalise_trials(Xs:list, ys:list):
 
     # make sure all sessions have the same number of trials
     for i,(X, y) in enumerate(zip(Xs, ys)):
-        Xs[i], ys[i] = n_trials(X, y, min_trials)
+        Xs[i], ys[i] = n_trials(X, y, min_trials, rng = rng)
+
+    return Xs, ys
+
+def run_jobs_parallel(func, jobs:list, n_workers:int = 1, threads_per_job:int = 1):
+    """
+    Runs func(**job) for every job in a pool of worker processes and returns the results in the order of the jobs.
 
-    return Xs, ys
\ No newline at end of file
+    Each worker is started with its thread environment variables (OMP_NUM_THREADS etc.) set to threads_per_job, so the available CPUs are split between the workers instead of every worker trying to use all of them. The thread budget is also passed to func as the keyword argument n_jobs.
+
+    Parameters
+    ----------
+    func : callable
+        Function to run. Has to be defined at module level so it can be pickled.
+    jobs : list
+        List of dictionaries with keyword arguments for func.
+    n_workers : int, optional
+        Number of worker processes. If 1, the jobs are run serially in the current process. The default is 1.
+    threads_per_job : int, optional
+        Number of threads each job is allowed to use. The default is 1.
+    
+    Returns
+    -------
+    results : list
+        List with the return value of func for each job.
+    """
+    if n_workers <= 1:
+        return [func(**job, n_jobs = threads_per_job) for job in jobs]
+
+    # the workers are spawned (not forked) so the thread limits are read when numpy/BLAS are imported in the worker
+    old_env = {var: os.environ.get(var) for var in THREAD_ENV_VARS}
+    try:
+        for var in THREAD_ENV_VARS:
+            os.environ[var] = str(threads_per_job)
+
+        with ProcessPoolExecutor(max_workers = n_workers, mp_context = multiprocessing.get_context("spawn")) as executor:
+            futures = [executor.submit(func, **job, n_jobs = threads_per_job) for job in jobs]
+            results = [future.result() for future in futures]
+    finally:
+        for var, value in old_env.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+    return results